@@ -1,6 +1,7 @@
 import tkinter as tk
 import threading
 import os
+import logging
 
 from tkinter import ttk, messagebox, filedialog
 from pathlib import Path
@@ -106,88 +107,60 @@ class ProcessAllPanel(tk.Frame):
         # workbook = openpyxl.Workbook()
         # sheet = workbook.active
             
-        for item in self.prep_treeview.get_children():
-            input_path = Path(self.prep_treeview.item(item)['values'][0])
-            output_path = input_path.parent.absolute()
-            
-            window.log_info(message= f"Building Cargo for case: {input_path}")
-            
-            cargo = load_cargo(
-                input_path = input_path,
-                output_path= output_path,
-            )
-            
-            window.log_info(message= f"Segementing Signals for case: {input_path}")
+        her2_classifier_path = DEFAULT_HER2_CLASSIFIER
+        chr17_classifier_path = DEFAULT_CHR17_CLASSIFIER
+        model_type = 'Cellpose'
+        
+        def load_cases():
+            for item in self.prep_treeview.get_children():
+                input_path = Path(self.prep_treeview.item(item)['values'][0])
+                output_path = input_path.parent.absolute()
             
-            process_parallel(
-                cargo = cargo,
-                her2_classifier_path = r'.\classifier\HER2\HER2-0.joblib', 
-                chr17_classifier_path = r'.\classifier\Chr17\Chr17-0.joblib', 
-                model_type= 'Cellpose',
-            )
+                window.log_info(message= f"Building Cargo for case: {input_path}")
             
-            window.log_info(message= f"Calculating for case: {input_path}")
+                yield load_cargo(
+                    input_path = input_path,
+                    output_path= output_path,
+                )
+        
+        def on_case_done(cargo, error):
+            if error is not None:
+                window.log_info(message= f"Processing failed for case: {cargo.input_path}: {error}")
+                return
             
             if window.status == 'ALL':
-                needed_cell = 20
-                final_cell_score = {}
-                final_cell_image = {}
+                try:
+                    final_cell_image, final_cell_score = select_report_cells(cargo, needed_cell=20, extended_cell=40)
                 
-                sher2, schr17, scell = 0, 0, 0
-                for _, _, _, her2, chr17, _ in cargo.all_cell_score[:needed_cell]:
-                    sher2 += int(her2)
-                    schr17 += int(chr17)
-                    scell += 1
+                    window.log_info(message= f"Creating report for case: {cargo.input_path}")
                 
-                if 1.8 <= float(round(sher2 / schr17, 3)) <= 2.2:
-                    needed_cell = 40
-                              
-                for name, cell_label, _, her2, chr17, _ in cargo.all_cell_score[:needed_cell]:
-                    container = cargo.get_container(name=name)
-                    raw_image = container.get(label= 'raw')
-                    her2_mask = cv2.cvtColor(container.get('her2').astype(np.uint8), cv2.COLOR_GRAY2BGR)
-                    her2_mask[np.where((her2_mask == [255, 255, 255]).all(axis=2))] = [0, 255, 0]
-                    chr17_mask = cv2.cvtColor(container.get('chr17').astype(np.uint8), cv2.COLOR_GRAY2BGR)
-                    chr17_mask[np.where((chr17_mask == [255, 255, 255]).all(axis=2))] = [0, 200, 255]
-                    cells_mask = container.get(label= 'cell')
-                    
-                    cell_mask = np.where(cells_mask == int(cell_label), 255, 0).astype(np.uint8)
-                    contours, _ = cv2.findContours(cell_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-                    boundary_image = raw_image.copy()
-                    boundary_image = cv2.drawContours(boundary_image, contours, 0, (255, 255, 0), 1)
-                    
-                    x1, y1, x2, y2, _, _ = cropping_region(
-                        input_cell_mask= cells_mask,
-                        id_value= int(cell_label),
-                        extend= 10,
+                    create_report(
+                        image_dict= final_cell_image,
+                        cell_dict= final_cell_score,
+                        report_output_path= cargo.report_path,
+                        # excel_output_path= cargo.report_excel_path,
                     )
-                    
-                    sraw_img = boundary_image[y1:y2, x1:x2]
-                    sher2_mask = her2_mask[y1:y2, x1:x2]
-                    schr17_mask = chr17_mask[y1:y2, x1:x2]
-                    
-                    overlay_img = cv2.addWeighted(sraw_img.copy(), 1, sher2_mask, 0.5, 0)
-                    overlay_img = cv2.addWeighted(overlay_img, 1, schr17_mask, 0.5, 0)
-                    
-                    sraw_img = Image.fromarray(sraw_img).convert('RGB')
-                    overlay_img = Image.fromarray(overlay_img).convert('RGB')
-                    
-                    cell_name = f'{name}_Cell-{str(cell_label).zfill(3)}'
-                    final_cell_score[cell_name] = [int(her2), int(chr17)]
-                    final_cell_image[cell_name] = [sraw_img, overlay_img]
-                
-                window.log_info(message= f"Creating report for case: {input_path}")
-                
-                create_report(
-                    image_dict= final_cell_image,
-                    cell_dict= final_cell_score,
-                    report_output_path= cargo.report_path,
-                    # excel_output_path= cargo.report_excel_path,
-                )
+                except Exception as e:
+                    logging.exception(f"Report failed for case: {cargo.input_path}")
+                    window.log_info(message= f"Report failed for case: {cargo.input_path}: {e}")
                 
                 # sheet.append([cargo.input_path.stem, sher2, schr17, scell])
-                
-            del cargo
+        
+        window.log_info(message= "Segementing Signals for all cases")
+        
+        # Keep one warm pool for every case so models are loaded only once per worker, and
+        # schedule the cases together so small ones keep every worker busy
+        with WorkerPool(her2_classifier_path, chr17_classifier_path, model_type) as pool:
+            process_cases(
+                load_cases(),
+                her2_classifier_path = her2_classifier_path, 
+                chr17_classifier_path = chr17_classifier_path, 
+                model_type= model_type,
+                pool= pool,
+                top_k= 40,
+                on_case_done= on_case_done,
+                max_cases= 4,
+            )
             
         # if workbook:
         #     workbook.save(r'F:\Lab\Her2DISH\calculate_numbers_accuracy\results.xlsx')
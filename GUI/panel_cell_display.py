@@ -280,16 +280,16 @@ class CellDisplayPanel(tk.Frame):
     def check_mask(self) -> None:
         try:
             container = self.window.cargo.get_container(self.name)
-            self.raw_image = container.get('raw')
+            self.raw_image = container.view('raw')
         except:
             self.raw_image = np.array(Image.open(self.path))
         
         try: 
-            self.her2_mask = cv2.cvtColor(container.get('her2').astype(np.uint8), cv2.COLOR_GRAY2BGR)
+            self.her2_mask = cv2.cvtColor(container.view('her2').astype(np.uint8), cv2.COLOR_GRAY2BGR)
             self.her2_mask[np.where((self.her2_mask == [255, 255, 255]).all(axis=2))] = [0, 255, 0]
-            self.chr17_mask = cv2.cvtColor(container.get('chr17').astype(np.uint8), cv2.COLOR_GRAY2BGR)
+            self.chr17_mask = cv2.cvtColor(container.view('chr17').astype(np.uint8), cv2.COLOR_GRAY2BGR)
             self.chr17_mask[np.where((self.chr17_mask == [255, 255, 255]).all(axis=2))] = [0, 200, 255]
-            self.cells_mask = container.get('cell')
+            self.cells_mask = container.view('cell')
         except:
             return
         
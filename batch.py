@@ -0,0 +1,215 @@
+import argparse
+import glob
+import json
+import logging
+import sys
+import time
+
+import tracing
+
+from pathlib import Path
+from typing import List
+
+from process import (
+    DEFAULT_CHR17_CLASSIFIER,
+    DEFAULT_HER2_CLASSIFIER,
+    WorkerPool,
+    load_cargo,
+    process_cases,
+)
+from storage import STORES
+from tools import create_report, select_report_cells
+
+
+def find_cases(patterns: List[str]) -> List[Path]:
+    """
+    Expand case folder paths and glob patterns into a sorted list of unique folders.
+
+    Args:
+        patterns (List[str]): Case folders or glob patterns matching them.
+
+    Returns:
+        List[Path]: The matching folders. Output folders of earlier runs are skipped.
+    """
+    cases = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        for match in matches:
+            path = Path(match)
+            if path.is_dir() and not path.name.endswith('_output'):
+                cases.add(path.absolute())
+    return sorted(cases)
+
+
+def write_report(cargo, args: argparse.Namespace) -> dict:
+    """
+    Create the report of a processed case.
+
+    Args:
+        cargo (CaseCargo): The processed case.
+        args (argparse.Namespace): Parsed command line options.
+
+    Returns:
+        dict: Report path, reported cells and their totals.
+    """
+    logging.info(f"Creating report for case: {cargo.input_path}")
+    image_dict, cell_dict = select_report_cells(
+        cargo, needed_cell=args.cells, extended_cell=args.extended_cells,
+    )
+    create_report(
+        image_dict=image_dict,
+        cell_dict=cell_dict,
+        report_output_path=cargo.report_path,
+        excel_output_path=cargo.report_excel_path,
+    )
+    total_her2 = sum(her2 for her2, _ in cell_dict.values())
+    total_chr17 = sum(chr17 for _, chr17 in cell_dict.values())
+    return {
+        'report': str(cargo.report_path),
+        'report_cells': cell_dict,
+        'total_her2': total_her2,
+        'total_chr17': total_chr17,
+        'ratio': round(total_her2 / total_chr17, 3) if total_chr17 else None,
+    }
+
+
+def write_summary(summary: dict, summary_path: Path) -> None:
+    """Write the JSON summary of a case."""
+    try:
+        summary_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(summary_path, 'w') as f:
+            json.dump(summary, f, indent=2)
+    except OSError as e:
+        logging.error(f"Could not write summary to {summary_path}: {e}")
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='batch',
+        description='Run the HER2/Chr17 DISH pipeline on case folders without the GUI.',
+    )
+    parser.add_argument('cases', nargs='+', help='Case folders or glob patterns, e.g. "data/*/case-*".')
+    parser.add_argument('--output', default=None, help='Base output folder (defaults to the parent of each case).')
+    parser.add_argument('--her2-classifier', default=DEFAULT_HER2_CLASSIFIER, help='Path to the HER2 classifier.')
+    parser.add_argument('--chr17-classifier', default=DEFAULT_CHR17_CLASSIFIER, help='Path to the Chr17 classifier.')
+    parser.add_argument('--model-type', default='Cellpose', choices=['Cellpose', 'StarDist', 'Threshold'], help='Cell segmentation model.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (defaults to the CPU count).')
+    parser.add_argument('--concurrent-cases', type=int, default=4, help='Maximum number of cases loaded and in flight at once.')
+    parser.add_argument('--mmap-mode', default=None, choices=['r'], help='Memory-map the classifiers in the workers.')
+    parser.add_argument('--classifier-tile-size', type=int, default=None, help='Classify in tiles of this size.')
+    parser.add_argument('--segmentation-tile-size', type=int, default=None, help='Segment in tiles of this size (after resizing) on large scans.')
+    parser.add_argument('--segment-batch-size', type=int, default=1, help='Number of images of a case segmented together in one task.')
+    parser.add_argument('--cell-dtype', default='uint16', choices=['uint16', 'uint32'], help='Dtype of the cell labels; uint32 for scans with more than 65535 cells.')
+    parser.add_argument('--signal-removal', default='fill', choices=['fill', 'inpaint'], help='How signals are removed before segmentation.')
+    parser.add_argument('--signal-removal-tile-size', type=int, default=None, help='Fill removed signals with the background color of tiles of this size.')
+    parser.add_argument('--heatmap-mode', default='exact', choices=['exact', 'decimated'], help='HER2 heatmap gating mode.')
+    parser.add_argument('--storage', default=None, choices=sorted(STORES), help='On-disk format of the saved layers (defaults to tiled TIFF).')
+    parser.add_argument('--io-workers', type=int, default=8, help='Number of images of a case opened concurrently.')
+    parser.add_argument('--cells', type=int, default=20, help='Number of cells in the report.')
+    parser.add_argument('--extended-cells', type=int, default=40, help='Number of cells in the report for a borderline ratio.')
+    parser.add_argument('--all-cells', action='store_true', help='Keep the ranking of every cell, not only the reported ones.')
+    parser.add_argument('--no-report', dest='report', action='store_false', help='Skip the report.')
+    parser.add_argument('--trace', default=None, help='Write a Chrome/Perfetto trace of every stage to this JSON file.')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None) -> int:
+    """
+    Run the batch pipeline.
+
+    Returns:
+        int: 0 if every case succeeded, 1 if any case failed, 2 if no case matched.
+    """
+    args = parse_args(argv)
+
+    cases = find_cases(args.cases)
+    if not cases:
+        logging.error(f"No case folders matched: {' '.join(args.cases)}")
+        return 2
+
+    logging.info(f"Processing {len(cases)} case(s).")
+    if args.trace:
+        tracing.enable()
+    summaries = {}
+    started = {}
+
+    def load_cases():
+        """Load each case only when the scheduler has room for it."""
+        for input_path in cases:
+            started[str(input_path)] = time.perf_counter()
+            output_path = Path(args.output) if args.output else input_path.parent
+            try:
+                logging.info(f"Building Cargo for case: {input_path}")
+                cargo = load_cargo(
+                    input_path=input_path, output_path=output_path,
+                    store=args.storage, io_workers=args.io_workers,
+                )
+            except Exception as e:
+                logging.exception(f"Could not load case: {input_path}")
+                summary = {'case': str(input_path), 'status': 'failed', 'error': f"{type(e).__name__}: {e}"}
+                summaries[str(input_path)] = summary
+                write_summary(summary, output_path / f'{input_path.stem}_output' / f'{input_path.stem}_summary.json')
+                continue
+            yield cargo
+
+    def on_case_done(cargo, error):
+        """Write the report and summary of a case as soon as it finishes."""
+        case = str(cargo.input_path)
+        summary = {
+            'case': case,
+            'status': 'failed',
+            'output': str(cargo.output_path),
+            'images': cargo.get_container_keys(),
+        }
+        if error is None:
+            try:
+                summary['scored_cells'] = cargo.scored_cells
+                summary['ranked_cells'] = len(cargo.all_cell_score)
+                if args.report and len(cargo.all_cell_score):
+                    summary.update(write_report(cargo, args))
+                summary['status'] = 'ok'
+            except Exception as e:
+                logging.exception(f"Report failed for case: {case}")
+                error = e
+        if error is not None:
+            summary['error'] = f"{type(error).__name__}: {error}"
+        summary['seconds'] = round(time.perf_counter() - started[case], 3)
+        summaries[case] = summary
+        write_summary(summary, cargo.output_path / f'{cargo.input_path.stem}_summary.json')
+
+    # Every case shares one warm pool and one scheduler, so small cases fill idle workers
+    with WorkerPool(
+        args.her2_classifier, args.chr17_classifier, args.model_type,
+        max_workers=args.workers, mmap_mode=args.mmap_mode,
+    ) as pool:
+        process_cases(
+            load_cases(),
+            her2_classifier_path=args.her2_classifier,
+            chr17_classifier_path=args.chr17_classifier,
+            model_type=args.model_type,
+            pool=pool,
+            classifier_tile_size=args.classifier_tile_size,
+            heatmap_mode=args.heatmap_mode,
+            top_k=None if args.all_cells else max(args.cells, args.extended_cells),
+            on_case_done=on_case_done,
+            max_cases=max(1, args.concurrent_cases),
+            segmentation_tile_size=args.segmentation_tile_size,
+            segment_batch_size=args.segment_batch_size,
+            cell_dtype=args.cell_dtype,
+            signal_removal_method=args.signal_removal,
+            signal_removal_tile_size=args.signal_removal_tile_size,
+        )
+
+    if args.trace:
+        logging.info(f"Trace written to {tracing.export_chrome_trace(args.trace)}")
+
+    failed = [summary['case'] for summary in summaries.values() if summary['status'] != 'ok']
+    logging.info(f"{len(summaries) - len(failed)} of {len(summaries)} case(s) succeeded.")
+    for case in failed:
+        logging.error(f"Failed: {case}")
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
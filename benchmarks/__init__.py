@@ -0,0 +1,5 @@
+"""
+Reproducible benchmarks of the processing stages on synthetic DISH images.
+
+Run from the repository root with `python -m benchmarks.run --help`.
+"""
@@ -0,0 +1,227 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+# The pipeline modules live at the repository root
+REPO_ROOT = Path(__file__).resolve().parent.parent
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+import process
+
+from benchmarks.synthetic import train_classifiers, write_case
+from utiles import ImageContainer
+
+STAGES = ['classify', 'dug', 'segment', 'overlay', 'score', 'end_to_end']
+
+
+def git_commit() -> Dict[str, object]:
+    """Return the current commit and whether the working tree has local changes."""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+    return {'commit': commit, 'dirty': dirty}
+
+
+def environment() -> Dict[str, object]:
+    """Describe the machine and the versions of the numerical packages."""
+    import importlib
+
+    packages = {}
+    for module_name in ('numpy', 'scipy', 'skimage', 'sklearn', 'cv2', 'joblib'):
+        try:
+            packages[module_name] = importlib.import_module(module_name).__version__
+        except ImportError:
+            packages[module_name] = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'packages': packages,
+    }
+
+
+def parse_size(value: str) -> Tuple[int, int]:
+    """Parse an image size given as 'HEIGHTxWIDTH' or a single side."""
+    parts = value.lower().split('x')
+    if len(parts) == 1:
+        return int(parts[0]), int(parts[0])
+    if len(parts) == 2:
+        return int(parts[0]), int(parts[1])
+    raise argparse.ArgumentTypeError(f"Invalid size '{value}', expected HEIGHTxWIDTH.")
+
+
+def time_call(func: Callable, repeats: int, setup: Callable = None) -> List[float]:
+    """Run `func` `repeats` times and return the wall time of each run; `setup` runs untimed before each."""
+    seconds = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def benchmark_stages(
+    case_path: Path,
+    her2_classifier_path: str,
+    chr17_classifier_path: str,
+    args: argparse.Namespace,
+) -> Dict[str, List[float]]:
+    """
+    Time every stage of the task graph in this process, on each image of a case.
+
+    Every stage reads the layers produced by the previous ones, as in `process_parallel`,
+    and nothing is written to disk between repeats.
+
+    Returns:
+        Dict[str, List[float]]: Wall time of every run of every stage, summed over the images.
+    """
+    timings = {stage: [0.0] * args.repeats for stage in STAGES if stage != 'end_to_end'}
+    output_path = Path(tempfile.mkdtemp(prefix='stages-', dir=case_path.parent))
+
+    for image_path in sorted(case_path.iterdir()):
+        container = ImageContainer(str(image_path), str(output_path))
+
+        def drop(*labels):
+            return lambda: [container.images.pop(label, None) for label in labels]
+
+        stages = [
+            ('classify', lambda: process.run_classifier(
+                container, her2_classifier_path, chr17_classifier_path, args.classifier_tile_size,
+            ), drop('her2', 'chr17')),
+            ('dug', lambda: process.run_signal_removal(container), None),
+            ('segment', lambda: process.run_segmentor(container, args.model_type, args.segmentation_tile_size), drop('cell')),
+            ('overlay', lambda: process.run_overlay(container), None),
+            ('score', lambda: process.run_calculation(container, container.name, args.heatmap_mode), None),
+        ]
+        for stage, func, setup in stages:
+            result = {}
+
+            def run(func=func):
+                result['value'] = func()
+
+            for idx, seconds in enumerate(time_call(run, args.repeats, setup)):
+                timings[stage][idx] += seconds
+
+            # Keep the layers of the last run for the next stages
+            if isinstance(result['value'], dict):
+                container.images.update(result['value'])
+
+    return timings
+
+
+def benchmark_end_to_end(
+    case_path: Path,
+    her2_classifier_path: str,
+    chr17_classifier_path: str,
+    args: argparse.Namespace,
+) -> List[float]:
+    """
+    Time `process_parallel` on a whole case, from loading the cargo to the merged ranking.
+
+    The worker pool is created and warmed up once, so model loading is not timed, and every
+    run writes to a fresh output folder so no stage is skipped.
+    """
+    with process.WorkerPool(
+        her2_classifier_path, chr17_classifier_path, args.model_type, max_workers=args.workers,
+    ) as pool:
+        def run():
+            output_path = tempfile.mkdtemp(prefix='end-to-end-', dir=case_path.parent)
+            cargo = process.load_cargo(input_path=case_path, output_path=output_path)
+            process.process_parallel(
+                cargo, her2_classifier_path, chr17_classifier_path, args.model_type,
+                pool=pool,
+                classifier_tile_size=args.classifier_tile_size,
+                heatmap_mode=args.heatmap_mode,
+                segmentation_tile_size=args.segmentation_tile_size,
+            )
+
+        # Warm-up run, so worker start-up is not timed
+        run()
+        return time_call(run, args.repeats)
+
+
+def summarize(seconds: List[float]) -> Dict[str, object]:
+    return {
+        'seconds': [round(value, 6) for value in seconds],
+        'median': round(statistics.median(seconds), 6),
+        'min': round(min(seconds), 6),
+    }
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.run',
+        description='Time each pipeline stage on synthetic DISH images.',
+    )
+    parser.add_argument('--sizes', nargs='+', type=parse_size, default=[(1024, 1024)], help='Image sizes as HEIGHTxWIDTH.')
+    parser.add_argument('--images', type=int, default=3, help='Number of images per case.')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed runs per stage.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic images and classifiers.')
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes for the end-to-end run.')
+    parser.add_argument('--model-type', default='Threshold', help="Segmentation backend, 'Threshold' runs offline.")
+    parser.add_argument('--classifier-tile-size', type=int, default=None, help='Classify in tiles of this size.')
+    parser.add_argument('--segmentation-tile-size', type=int, default=None, help='Segment in tiles of this size.')
+    parser.add_argument('--heatmap-mode', default='exact', choices=['exact', 'decimated'], help='HER2 heatmap gating mode.')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help='Stages to time.')
+    parser.add_argument('--output', default='benchmark-results.json', help='Path of the JSON results.')
+    return parser.parse_args(argv)
+
+
+def main(argv: List[str] = None) -> int:
+    args = parse_args(argv)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {
+        **git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'environment': environment(),
+        'config': {**vars(args), 'sizes': [list(size) for size in args.sizes]},
+        'results': [],
+    }
+
+    with tempfile.TemporaryDirectory(prefix='her2dish-bench-') as work_dir:
+        work_dir = Path(work_dir)
+        her2_classifier_path, chr17_classifier_path = train_classifiers(work_dir / 'classifier', seed=args.seed)
+
+        for height, width in args.sizes:
+            case_path = write_case(work_dir / f'case-{height}x{width}' / 'case', args.images, height, width, args.seed)
+
+            timings = {}
+            if set(args.stages) - {'end_to_end'}:
+                timings.update(benchmark_stages(case_path, her2_classifier_path, chr17_classifier_path, args))
+            if 'end_to_end' in args.stages:
+                timings['end_to_end'] = benchmark_end_to_end(case_path, her2_classifier_path, chr17_classifier_path, args)
+
+            for stage in args.stages:
+                entry = {'size': [height, width], 'images': args.images, 'stage': stage, **summarize(timings[stage])}
+                results['results'].append(entry)
+                print(f"{height}x{width} {stage:>10}: median {entry['median']:.3f}s  min {entry['min']:.3f}s")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
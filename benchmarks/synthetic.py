@@ -0,0 +1,157 @@
+import numpy as np
+
+from pathlib import Path
+from typing import Tuple
+
+
+def make_dish_image(
+    height: int = 1024,
+    width: int = 1024,
+    seed: int = 0,
+    nucleus_radius: int = 18,
+    spacing: int = 52,
+    her2_dots: Tuple[int, int] = (1, 8),
+    chr17_dots: Tuple[int, int] = (1, 4),
+    dot_radius: int = 2,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Generates a synthetic brightfield DISH image with nuclei and HER2/Chr17 dots.
+
+    Nuclei are jittered ellipses in hematoxylin purple on a pale background, HER2 dots are
+    black and Chr17 dots are red, as in silver/red DISH staining. The same seed always gives
+    the same image.
+
+    Parameters:
+    - height (int): Image height in pixels.
+    - width (int): Image width in pixels.
+    - seed (int): Seed of the random generator.
+    - nucleus_radius (int): Mean nucleus radius in pixels.
+    - spacing (int): Distance between nuclei on the jittered grid.
+    - her2_dots (Tuple[int, int]): Range of HER2 dots per nucleus (inclusive).
+    - chr17_dots (Tuple[int, int]): Range of Chr17 dots per nucleus (inclusive).
+    - dot_radius (int): Radius of the signal dots in pixels.
+
+    Returns:
+    - image (np.ndarray): RGB uint8 image.
+    - cell_mask (np.ndarray): uint16 labels of the nuclei.
+    - her2_mask (np.ndarray): Boolean mask of the HER2 dots.
+    - chr17_mask (np.ndarray): Boolean mask of the Chr17 dots.
+    """
+    import cv2
+    
+    rng = np.random.default_rng(seed)
+    
+    cell_mask = np.zeros((height, width), dtype=np.uint16)
+    her2_mask = np.zeros((height, width), dtype=np.uint8)
+    chr17_mask = np.zeros((height, width), dtype=np.uint8)
+    
+    label = 1
+    margin = nucleus_radius + 4
+    for cy in range(margin, height - margin, spacing):
+        for cx in range(margin, width - margin, spacing):
+            # Jittered, elongated nucleus
+            y = int(cy + rng.integers(-spacing // 8, spacing // 8 + 1))
+            x = int(cx + rng.integers(-spacing // 8, spacing // 8 + 1))
+            axes = (int(nucleus_radius * rng.uniform(0.8, 1.2)), int(nucleus_radius * rng.uniform(0.7, 1.0)))
+            angle = float(rng.uniform(0, 180))
+            cv2.ellipse(cell_mask, (x, y), axes, angle, 0, 360, label, -1)
+            label += 1
+            
+            # Dots inside the nucleus
+            inner = int(min(axes) * 0.6)
+            for mask, (low, high) in ((her2_mask, her2_dots), (chr17_mask, chr17_dots)):
+                for _ in range(int(rng.integers(low, high + 1))):
+                    dy, dx = rng.integers(-inner, inner + 1, size=2)
+                    cv2.circle(mask, (int(x + dx), int(y + dy)), dot_radius, 1, -1)
+    
+    her2_mask = her2_mask.astype(bool)
+    chr17_mask = chr17_mask.astype(bool) & ~her2_mask
+    
+    # Pale background and purple nuclei with mild texture noise
+    image = np.empty((height, width, 3), dtype=np.float32)
+    image[...] = (228, 222, 218)
+    image[cell_mask != 0] = (150, 118, 172)
+    image += rng.normal(0, 6, size=image.shape).astype(np.float32)
+    image = cv2.GaussianBlur(image, (0, 0), 0.8)
+    
+    image[her2_mask] = (25, 25, 30)
+    image[chr17_mask] = (205, 45, 50)
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    
+    return image, cell_mask, her2_mask, chr17_mask
+
+
+def write_case(
+    case_path: str,
+    n_images: int = 3,
+    height: int = 1024,
+    width: int = 1024,
+    seed: int = 0,
+) -> Path:
+    """
+    Writes a synthetic case folder of PNG images.
+
+    Parameters:
+    - case_path (str): Folder to create the images in.
+    - n_images (int): Number of images in the case.
+    - height (int): Image height in pixels.
+    - width (int): Image width in pixels.
+    - seed (int): Seed of the first image; image i uses seed + i.
+
+    Returns:
+    - Path: The case folder.
+    """
+    from PIL import Image
+    
+    case_path = Path(case_path)
+    case_path.mkdir(parents=True, exist_ok=True)
+    for idx in range(n_images):
+        image, _, _, _ = make_dish_image(height, width, seed=seed + idx)
+        Image.fromarray(image).save(case_path / f'image-{idx:02d}.png')
+    return case_path
+
+
+def train_classifiers(
+    output_path: str,
+    size: int = 384,
+    seed: int = 0,
+    n_estimators: int = 10,
+) -> Tuple[str, str]:
+    """
+    Trains small HER2 and Chr17 random forest classifiers on a synthetic image.
+
+    The feature configuration matches the defaults of `Classifier`, so the classifiers can be
+    used by the pipeline as is.
+
+    Parameters:
+    - output_path (str): Folder to save the classifiers in.
+    - size (int): Side of the square training image.
+    - seed (int): Seed of the training image and the forests.
+    - n_estimators (int): Number of trees per forest.
+
+    Returns:
+    - Tuple[str, str]: Paths of the HER2 and Chr17 classifiers.
+    """
+    import joblib
+    from sklearn.ensemble import RandomForestClassifier
+    from skimage import future
+    from classify import Classifier
+    
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    
+    image, _, her2_mask, chr17_mask = make_dish_image(size, size, seed=seed)
+    features = Classifier()._extract_features(image)
+    
+    paths = []
+    for name, mask in (('HER2', her2_mask), ('Chr17', chr17_mask)):
+        # Background 1, foreground 2, as expected by `Classifier._restore_mask`
+        labels = np.where(mask, 2, 1).astype(np.uint8)
+        classifier = RandomForestClassifier(n_estimators=n_estimators, max_depth=10, random_state=seed, n_jobs=1)
+        classifier = future.fit_segmenter(labels, features, classifier)
+        
+        path = output_path / f'{name}-synthetic.joblib'
+        joblib.dump(classifier, path)
+        paths.append(str(path))
+    
+    return paths[0], paths[1]
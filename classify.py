@@ -1,5 +1,107 @@
 import numpy as np
 
+from collections import OrderedDict
+from typing import List
+
+
+class ClassifierCache:
+    """
+    A bounded, least-recently-used cache of pre-trained classifiers.
+
+    Entries are keyed by the resolved file path, its modification time and the
+    memory-map mode, so retraining a classifier in place is picked up on the next
+    load, and a memory-mapped load never returns a fully loaded copy.
+    """
+
+    def __init__(self, maxsize: int = 4) -> None:
+        """
+        Parameters:
+        - maxsize (int): Maximum number of classifiers kept in memory.
+        """
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+
+    def load(self, classifier_path: str, mmap_mode: str = None):
+        """
+        Return the classifier stored at the given path, loading it on a cache miss.
+
+        Parameters:
+        - classifier_path (str): Path to the pre-trained classifier file.
+        - mmap_mode (str): Passed to joblib.load on a cache miss. With 'r' the tree arrays are
+          memory-mapped, so worker processes share the same pages instead of holding private
+          copies. Only applies to classifiers saved without compression.
+
+        Returns:
+        - The unpickled classifier.
+        """
+        import os
+        import joblib
+        
+        classifier_path = os.path.abspath(classifier_path)
+        try:
+            mtime = os.stat(classifier_path).st_mtime_ns
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Classifier file not found at '{classifier_path}'.")
+        
+        key = (classifier_path, mtime, mmap_mode)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        
+        try:
+            classifier = joblib.load(classifier_path, mmap_mode=mmap_mode)
+        except Exception as e:
+            raise RuntimeError(f"An error occurred while loading the classifier: {e}")
+        
+        # Drop any stale copy of the same file before inserting the new one
+        for stale_key in [k for k in self._entries if k[0] == classifier_path and k[1] != mtime]:
+            del self._entries[stale_key]
+        
+        self._entries[key] = classifier
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return classifier
+
+    def clear(self) -> None:
+        """Remove every cached classifier."""
+        self._entries.clear()
+
+
+# Process-wide cache shared by every Classifier instance.
+_classifier_cache = ClassifierCache()
+
+# mmap mode used when a load does not ask for one, e.g. set by a worker pool for its workers.
+_default_mmap_mode: str = None
+
+
+def set_default_mmap_mode(mmap_mode: str = None) -> None:
+    """
+    Set the mmap mode of the classifier loads in this process that do not specify one.
+
+    Parameters:
+    - mmap_mode (str): joblib mmap mode, e.g. 'r', or None to load classifiers fully.
+    """
+    global _default_mmap_mode
+    _default_mmap_mode = mmap_mode
+
+
+def load_classifier(classifier_path: str, mmap_mode: str = None):
+    """
+    Load a pre-trained classifier through the process-wide cache.
+
+    Parameters:
+    - classifier_path (str): Path to the pre-trained classifier file.
+    - mmap_mode (str): Optional joblib mmap mode, e.g. 'r'. Defaults to the mode set with
+      `set_default_mmap_mode`, so the classifiers a worker preloaded are the ones it reuses.
+
+    Returns:
+    - The unpickled classifier.
+    """
+    if mmap_mode is None:
+        mmap_mode = _default_mmap_mode
+    return _classifier_cache.load(classifier_path, mmap_mode=mmap_mode)
+
+
 class Classifier:
     """
     A classifier for image segmentation using pre-trained models and multiscale features.
@@ -15,6 +117,8 @@ class Classifier:
         sigma_min: int = 1,
         sigma_max: int = 8,
         channel_axis: int = -1,
+        mmap_mode: str = None,
+        tile_size: int = None,
     ) -> None:
         """
         Initialize the classifier with given parameters.
@@ -27,6 +131,10 @@ class Classifier:
         - sigma_min (int): Minimum sigma for Gaussian blur in multiscale features.
         - sigma_max (int): Maximum sigma for Gaussian blur in multiscale features.
         - channel_axis (int): The axis corresponding to color channels in the image.
+        - mmap_mode (str): Optional joblib mmap mode used when loading classifiers, e.g. 'r'. If
+          omitted, the process default is used (see `set_default_mmap_mode`).
+        - tile_size (int): If set, features are extracted and predicted tile by tile (in resized
+          pixels), so peak memory depends on the tile size instead of the image size.
         """
         self.resize_scale = resize_scale
         self.advanced_features = advanced_features
@@ -36,6 +144,28 @@ class Classifier:
         self.sigma_min = sigma_min
         self.sigma_max = sigma_max
         self.channel_axis = channel_axis
+        self.mmap_mode = mmap_mode
+        self.tile_size = tile_size
+
+    def parameters(self) -> dict:
+        """
+        Return the settings that determine the predicted masks, e.g. for cache invalidation.
+
+        The tile size is left out since tiled and whole-image predictions are identical.
+
+        Returns:
+        - dict: Resize scale and feature configuration.
+        """
+        return {
+            'resize_scale': self.resize_scale,
+            'advanced_features': self.advanced_features,
+            'intensity': self.intensity,
+            'edges': self.edges,
+            'texture': self.texture,
+            'sigma_min': self.sigma_min,
+            'sigma_max': self.sigma_max,
+            'channel_axis': self.channel_axis,
+        }
 
     def run(
         self,
@@ -54,32 +184,29 @@ class Classifier:
         Returns:
         - np.ndarray: Segmentation mask with values mapped according to the desired dtype.
         """
-        # Load the pre-trained classifier from the given path
-        import joblib
-        
-        from skimage import feature, future
-        from functools import partial
-        
-        try:
-            classifier = joblib.load(classifier_path)
-        except FileNotFoundError:
-            raise FileNotFoundError(f"Classifier file not found at '{classifier_path}'.")
-        except Exception as e:
-            raise RuntimeError(f"An error occurred while loading the classifier: {e}")
+        return self.run_batch(input_img, [classifier_path], output_dtype)[0]
 
-        # Create a partial function for multiscale feature extraction with predefined parameters
-        extract_features = partial(
-            feature.multiscale_basic_features,
-            intensity=self.intensity,
-            edges=self.edges,
-            texture=self.texture,
-            sigma_min=self.sigma_min,
-            sigma_max=self.sigma_max,
-            channel_axis=self.channel_axis,
-        )
+    def run_batch(
+        self,
+        input_img: np.ndarray,
+        classifier_paths: List[str],
+        output_dtype: np.dtype = np.uint16,
+    ) -> List[np.ndarray]:
+        """
+        Run several classifiers on the same image, extracting its features only once.
+
+        Parameters:
+        - input_img (np.ndarray): The input image array.
+        - classifier_paths (List[str]): Paths to the pre-trained classifier files.
+        - output_dtype (np.dtype): Desired data type of the output masks.
+
+        Returns:
+        - List[np.ndarray]: One segmentation mask per classifier, in the order given.
+        """
+        from cv2 import resize, INTER_AREA
         
-        from cv2 import resize, INTER_AREA, INTER_NEAREST
-        from csbdeep.utils import normalize
+        # Load the pre-trained classifiers, reusing them if this process already has them
+        classifiers = [load_classifier(path, mmap_mode=self.mmap_mode) for path in classifier_paths]
         
         # Store the original image dimensions
         old_width = int(input_img.shape[1])
@@ -92,17 +219,137 @@ class Classifier:
         # Resize the image to reduce computation time and memory usage
         img_resized = resize(input_img, (new_width, new_height), interpolation=INTER_AREA)
         
-        # Extract features if advanced_features is True, else use the original image
-        if self.advanced_features:
-            features = extract_features(img_resized)
-            # Predict segmentation using the extracted features
-            mask = future.predict_segmenter(features, classifier)
+        if self.tile_size:
+            masks = self._predict_tiled(img_resized, classifiers, classifier_paths)
         else:
-            # Predict segmentation directly on the image
-            mask = future.predict_segmenter(img_resized, classifier)
+            masks = self._predict(img_resized, classifiers, classifier_paths)
+        
+        return [self._restore_mask(mask, old_width, old_height, output_dtype) for mask in masks]
+
+    def _extract_features(self, img: np.ndarray) -> np.ndarray:
+        """Return the feature stack of an image, or the image itself without advanced features."""
+        from skimage import feature
+        
+        if not self.advanced_features:
+            return img
+        
+        return feature.multiscale_basic_features(
+            img,
+            intensity=self.intensity,
+            edges=self.edges,
+            texture=self.texture,
+            sigma_min=self.sigma_min,
+            sigma_max=self.sigma_max,
+            channel_axis=self.channel_axis,
+        )
+
+    def _predict(
+        self,
+        img: np.ndarray,
+        classifiers: list,
+        classifier_paths: List[str],
+    ) -> List[np.ndarray]:
+        """Predict every classifier on the feature stack of the whole image."""
+        from skimage import future
+        
+        features = self._extract_features(img)
+        self._check_features(features, classifiers, classifier_paths)
+        
+        # Predict segmentation with every classifier on the shared feature stack
+        return [future.predict_segmenter(features, classifier) for classifier in classifiers]
+
+    def _halo(self) -> int:
+        """
+        Return the number of context pixels a tile needs so its features match the whole-image ones.
+
+        Gaussian blurs are truncated at 4 sigma, the Hessian adds two central differences and
+        the Sobel filter one more pixel.
+        """
+        if not self.advanced_features:
+            return 0
+        return int(4 * self.sigma_max + 0.5) + 3
+
+    def _predict_tiled(
+        self,
+        img: np.ndarray,
+        classifiers: list,
+        classifier_paths: List[str],
+    ) -> List[np.ndarray]:
+        """
+        Predict every classifier tile by tile and write the results into preallocated masks.
+
+        Each tile is extended by a halo sized from `sigma_max` before its features are extracted,
+        and only the pixels of the tile itself are predicted, so the result matches `_predict`.
+        """
+        from skimage import future
+        
+        height, width = img.shape[:2]
+        halo = self._halo()
+        masks = [None] * len(classifiers)
+        
+        for y in range(0, height, self.tile_size):
+            for x in range(0, width, self.tile_size):
+                # Tile extended by the halo, clipped to the image
+                y0, y1 = max(y - halo, 0), min(y + self.tile_size + halo, height)
+                x0, x1 = max(x - halo, 0), min(x + self.tile_size + halo, width)
+                tile_height = min(self.tile_size, height - y)
+                tile_width = min(self.tile_size, width - x)
+                
+                features = self._extract_features(img[y0:y1, x0:x1])
+                if y == 0 and x == 0:
+                    self._check_features(features, classifiers, classifier_paths)
+                
+                # Keep only the features of the tile itself
+                features = features[y - y0:y - y0 + tile_height, x - x0:x - x0 + tile_width]
+                
+                for idx, classifier in enumerate(classifiers):
+                    prediction = future.predict_segmenter(features, classifier)
+                    if masks[idx] is None:
+                        masks[idx] = np.empty((height, width), dtype=prediction.dtype)
+                    masks[idx][y:y + tile_height, x:x + tile_width] = prediction
+        
+        return masks
+
+    @staticmethod
+    def _check_features(features: np.ndarray, classifiers: list, classifier_paths: List[str]) -> None:
+        """
+        Ensure every classifier was trained on the same number of features as the extracted stack.
 
+        Raises:
+        - ValueError: If a classifier expects a different feature configuration.
+        """
+        n_features = features.shape[-1] if features.ndim == 3 else 1
+        for classifier, path in zip(classifiers, classifier_paths):
+            expected = getattr(classifier, 'n_features_in_', None)
+            if expected is not None and expected != n_features:
+                raise ValueError(
+                    f"Classifier '{path}' was trained on {expected} features, but the current "
+                    f"feature configuration produces {n_features}."
+                )
+
+    @staticmethod
+    def _restore_mask(
+        mask: np.ndarray,
+        width: int,
+        height: int,
+        output_dtype: np.dtype,
+    ) -> np.ndarray:
+        """
+        Resize a predicted mask back to the original image size and map its classes to the output dtype.
+
+        Parameters:
+        - mask (np.ndarray): Predicted mask with background 1 and foreground 2.
+        - width (int): Width of the original image.
+        - height (int): Height of the original image.
+        - output_dtype (np.dtype): Desired data type of the output mask.
+
+        Returns:
+        - np.ndarray: Mask with background 0 and foreground at the highest value of the dtype.
+        """
+        from cv2 import resize, INTER_NEAREST
+        
         # Resize the segmentation mask back to the original image dimensions
-        mask_resized = resize(mask, (old_width, old_height), interpolation=INTER_NEAREST)
+        mask_resized = resize(mask, (width, height), interpolation=INTER_NEAREST)
 
         # Convert the mask to the specified output_dtype
         mask_resized = mask_resized.astype(output_dtype)
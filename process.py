@@ -1,11 +1,17 @@
 import logging
 import numpy as np
 
-from utiles import CaseCargo, ImageContainer
-from classify import Classifier
+import tracing
+
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from utiles import CaseCargo, ImageContainer, LayerWriter, SharedContainer, file_digest, stage_hash
+from classify import Classifier, load_classifier, set_default_mmap_mode
 from segmentation import Segment
-from anaylsis import calculate_all_score
-from tools import overlay_signal
+from anaylsis import calculate_all_score, top_k_scores
+from tools import overlay_signal, remove_signal
 
 # Configure logging to show messages from each process
 logging.basicConfig(
@@ -14,90 +20,217 @@ logging.basicConfig(
     datefmt='%H:%M:%S'
 )
 
-def load_cargo(input_path: str, output_path: str) -> CaseCargo:
-    return CaseCargo(input_path=input_path, output_path=output_path)
+# Classifiers bundled with the repository.
+CLASSIFIER_DIR = Path(__file__).resolve().parent / 'classifier'
+DEFAULT_HER2_CLASSIFIER = str(CLASSIFIER_DIR / 'HER2' / 'HER2-0.joblib')
+DEFAULT_CHR17_CLASSIFIER = str(CLASSIFIER_DIR / 'CHR17' / 'CHR17-0.joblib')
+
+# Scale at which the cell segmentation runs.
+SEGMENTATION_RESIZE_SCALE = 0.333
+
+# Default settings of the signal removal stage (see `tools.remove_signal`). The settings a 'dug' layer
+# was made with are recorded in its manifest hash; `method` and `tile_size` can be set per run.
+SIGNAL_REMOVAL_PARAMETERS = {'method': 'fill', 'distance': 3, 'background_tolerance': 10, 'tile_size': None}
+
+# Segmentation models already loaded in this process, keyed by (model_type, resize_scale).
+_segmenters: Dict[Tuple[str, float], Segment] = {}
+
+
+def get_segmenter(
+    model_type: str,
+    resize_scale: float = SEGMENTATION_RESIZE_SCALE,
+    tile_size: int = None,
+) -> Segment:
+    """
+    Return the segmenter for the given model type, loading its weights only once per process.
+
+    Args:
+        model_type (str): Type of model to be used for segmentation ('StarDist', 'Cellpose').
+        resize_scale (float): Scale factor applied to the image before segmentation.
+        tile_size (int): Segment in tiles of this size (in resized pixels), or None for whole images.
+
+    Returns:
+        Segment: The cached segmenter.
+    """
+    key = (model_type, resize_scale)
+    if key not in _segmenters:
+        _segmenters[key] = Segment(model_type=model_type, resize_scale=resize_scale)
+    # Tiling only changes how the loaded model is run, so every tile size shares it
+    segmenter = _segmenters[key]
+    segmenter.tile_size = tile_size
+    return segmenter
+
+
+def segmenter_parameters(
+    model_type: str,
+    resize_scale: float = SEGMENTATION_RESIZE_SCALE,
+    tile_size: int = None,
+    shape: Tuple[int, ...] = None,
+) -> dict:
+    """
+    Return the parameters of a segmenter without loading its model.
+
+    With `shape`, the tile settings are only included if an image of that shape is segmented in tiles.
+    """
+    return Segment(model_type=model_type, resize_scale=resize_scale, tile_size=tile_size, load_model=False).parameters(shape)
 
 
+def _init_worker(
+    her2_classifier_path: str,
+    chr17_classifier_path: str,
+    model_type: str,
+    mmap_mode: str = None,
+) -> None:
+    """Load the classifiers and the segmentation model once when a worker process starts."""
+    # Tasks load classifiers without a mode, so they get the memory-mapped copies preloaded here
+    set_default_mmap_mode(mmap_mode)
+    # A failure here would break the whole pool, so it is only logged; the task that
+    # needs the model raises the actual error when it tries to load it again.
+    try:
+        for classifier_path in (her2_classifier_path, chr17_classifier_path):
+            if classifier_path is not None:
+                load_classifier(classifier_path, mmap_mode=mmap_mode)
+        if model_type is not None:
+            get_segmenter(model_type)
+    except Exception as e:
+        logging.warning(f"Could not preload worker models: {e}")
+        return
+    logging.info("Worker models loaded.")
+
+
+class WorkerPool:
+    """
+    A long-lived process pool whose workers keep their models loaded between cases.
+
+    Each worker loads the HER2 and Chr17 classifiers and the segmentation model once,
+    in its initializer, and reuses them for every container it processes until the pool
+    is shut down. Models that were not preloaded are loaded on first use and then cached
+    in the same way.
+    """
+
+    def __init__(
+        self,
+        her2_classifier_path: str = None,
+        chr17_classifier_path: str = None,
+        model_type: str = None,
+        max_workers: int = None,
+        mmap_mode: str = None,
+    ) -> None:
+        """
+        Args:
+            her2_classifier_path (str): Path to the HER2 classifier to preload.
+            chr17_classifier_path (str): Path to the Chr17 classifier to preload.
+            model_type (str): Segmentation model to preload ('StarDist', 'Cellpose').
+            max_workers (int): Number of worker processes (defaults to the CPU count).
+            mmap_mode (str): joblib mmap mode for the preloaded classifiers, e.g. 'r' to
+                share the tree arrays between workers through the page cache.
+        """
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(her2_classifier_path, chr17_classifier_path, model_type, mmap_mode),
+        )
+
+    def submit(self, fn, *args, **kwargs):
+        """Submit a task to the pool and return its future."""
+        return self.executor.submit(fn, *args, **kwargs)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the worker processes and release their models."""
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self) -> 'WorkerPool':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+
+
+def load_cargo(input_path: str, output_path: str, store: str = None, io_workers: int = 8) -> CaseCargo:
+    return CaseCargo(input_path=input_path, output_path=output_path, store=store, io_workers=io_workers)
+
+
+@tracing.traced('classify')
 def run_classifier(
     container: ImageContainer, 
     her2_classifier_path: str, 
     chr17_classifier_path: str,
+    tile_size: int = None,
 ) -> dict:
     """
     Classify HER2 and Chr17 signals for a single container and return the results.
     Returns a dictionary with the classified masks.
+
+    If `tile_size` is given, features are extracted and predicted tile by tile to bound memory.
     """
-    classifier = Classifier()
+    classifier = Classifier(tile_size=tile_size)
     
     container_key = container.name
     existing_images = container.images
     
-    result = {}
+    # Classify only the signals that are missing, sharing one feature extraction
+    signals = [('her2', 'HER2', her2_classifier_path), ('chr17', 'Chr17', chr17_classifier_path)]
+    missing = []
+    for label, signal_name, classifier_path in signals:
+        if label in existing_images:
+            logging.info(f"Skipping {signal_name} classification for container '{container_key}', already exists.")
+        else:
+            missing.append((label, signal_name, classifier_path))
     
-    # Process HER2 signal if not already classified
-    if 'her2' not in existing_images:
-        logging.info(f"Running HER2 classifier for container '{container_key}'...")
-        her2_mask = classifier.run(
-            input_img=container.get('raw'),
-            classifier_path=her2_classifier_path,
-            output_dtype=np.uint16
-        )
-        result['her2'] = her2_mask
-        logging.info(f"HER2 classification completed for container '{container_key}'.")
-    else:
-        logging.info(f"Skipping HER2 classification for container '{container_key}', already exists.")
-
-    # Process Chr17 signal if not already classified
-    if 'chr17' not in existing_images:
-        logging.info(f"Running Chr17 classifier for container '{container_key}'...")
-        chr17_mask = classifier.run(
-            input_img=container.get('raw'),
-            classifier_path=chr17_classifier_path,
-            output_dtype=np.uint16
-        )
-        result['chr17'] = chr17_mask
-        logging.info(f"Chr17 classification completed for container '{container_key}'.")
-    else:
-        logging.info(f"Skipping Chr17 classification for container '{container_key}', already exists.")
-    
-    # Remove signal
-    if 'dug' not in existing_images:
-        logging.info(f"Running signal removal for container '{container_key}'...")
-        from skimage.segmentation import expand_labels
-        try: her2_mask 
-        except: her2_mask = existing_images['her2']
-        try: chr17_mask
-        except: chr17_mask = existing_images['chr17']
-        
-        both_mask = her2_mask + chr17_mask
-        both_mask = expand_labels(both_mask, distance=3)
-        
-        raw_image = container.get('raw')
-        temp_image = container.get('raw')
-        mask = np.all(np.abs(temp_image - np.mean(raw_image, axis=(0, 1))) > 10, axis=-1)
-        temp_image = temp_image[mask]
-        
-        raw_image[both_mask != 0] = np.mean(temp_image, axis=0)
-        result['dug'] = raw_image
-        logging.info(f"Signal removal completed for container '{container_key}'.")
-    else:
-        logging.info(f"Skipping signal removal for container '{container_key}', already exists.")
-        
-    return result
+    if not missing:
+        return {}
+    
+    signal_names = ' and '.join(signal_name for _, signal_name, _ in missing)
+    logging.info(f"Running {signal_names} classifier for container '{container_key}'...")
+    masks = classifier.run_batch(
+        input_img=container.view('raw'),
+        classifier_paths=[classifier_path for _, _, classifier_path in missing],
+        output_dtype=np.uint16
+    )
+    logging.info(f"{signal_names} classification completed for container '{container_key}'.")
+    
+    return {label: mask for (label, _, _), mask in zip(missing, masks)}
+
+
+@tracing.traced('dug')
+def run_signal_removal(container: ImageContainer, method: str = 'fill', tile_size: int = None) -> dict:
+    """
+    Remove the classified HER2 and Chr17 signals from the raw image of a single container.
+    Returns a dictionary with the signal-free 'dug' image.
+
+    `method` ('fill', 'inpaint') and `tile_size` are passed to `tools.remove_signal`; the other
+    settings come from `SIGNAL_REMOVAL_PARAMETERS`.
+    """
+    container_key = container.name
+    
+    logging.info(f"Running signal removal for container '{container_key}'...")
+    dug_image = remove_signal(
+        image=container.view('raw'),
+        her2_mask=container.view('her2'),
+        chr17_mask=container.view('chr17'),
+        **{**SIGNAL_REMOVAL_PARAMETERS, 'method': method, 'tile_size': tile_size},
+    )
+    logging.info(f"Signal removal completed for container '{container_key}'.")
+    
+    return {'dug': dug_image}
 
 
+@tracing.traced('segment')
 def run_segmentor(
     container: ImageContainer,
     model_type: str,
+    tile_size: int = None,
+    cell_dtype: np.dtype = np.uint16,
 ) -> dict:
     """
-    Run the segmentation process on a given raw image for the specified container key.
+    Run the segmentation process on the signal-free image of a single container.
 
     Args:
-        container_key (str): Key identifying the container in which the image is stored.
-        raw_image (np.ndarray): Raw image data to be segmented.
+        container (ImageContainer): Container holding the 'dug' image to be segmented.
         model_type (str): Type of model to be used for segmentation ('StarDist', 'Cellpose').
-        existing_images (dict): Dictionary of existing images in the container.
+        tile_size (int): Segment in tiles of this size (in resized pixels) to bound memory, or None.
+        cell_dtype (np.dtype): Dtype of the cell labels, np.uint16 or np.uint32 for scans with
+            more than 65535 cells.
     
     Returns:
         dict: Contains the result of segmentation (e.g., cell mask) if it is computed.
@@ -107,133 +240,643 @@ def run_segmentor(
     container_key = container.name
     existing_images = container.images
 
-    # Process Chr17 signal if it doesn't exist in the existing images
+    # Segment cells if the cell mask doesn't exist in the existing images
     if 'cell' not in existing_images:
         logging.info(f"Running border segmentation for container '{container_key}'...")
-        segmenter = Segment(model_type=model_type, resize_scale=0.333)
+        segmenter = get_segmenter(model_type, tile_size=tile_size)
         cell_mask = segmenter.run(
-            input_img=container.get('dug'),
-            output_dtype=np.uint16
+            input_img=container.view('dug'),
+            output_dtype=cell_dtype
         )
         result['cell'] = cell_mask
         logging.info(f"Border Segmentation completed for container '{container_key}'.")
     else:
         logging.info(f"Skipping border segmentation for container '{container_key}', already exists.")
     
-    if 'overlay' not in existing_images:
-        logging.info(f"Running Signal overlay for container '{container_key}'...")
-        overlay_img = overlay_signal(
-            image= container.get('raw'),
-            mask= container.get('her2'),
-            color= [0, 255, 0],
-            transparent= 0.5,
-        )
-        overlay_img = overlay_signal(
-            image= overlay_img,
-            mask= container.get('chr17'),
-            color= [0, 200, 255],
-            transparent= 0.5,
-        )
-        result['overlay'] = overlay_img
-        logging.info(f"Signal overlay completed for container '{container_key}'.")
-    else:
-        logging.info(f"Skipping signal overlay for container '{container_key}', already exists.")
-    
     return result
 
 
-def run_calculation(container: ImageContainer, name: str) -> list:
+@tracing.traced('segment')
+def run_segmentor_batch(
+    containers: List[ImageContainer],
+    model_type: str,
+    tile_size: int = None,
+    cell_dtype: np.dtype = np.uint16,
+) -> List[dict]:
+    """
+    Run the segmentation process on the signal-free images of several containers at once.
+
+    The images go through `Segment.run_batch`, so model and framework overhead is paid once
+    per batch instead of once per image.
+
+    Args:
+        containers (List[ImageContainer]): Containers holding the 'dug' images to be segmented.
+        model_type (str): Type of model to be used for segmentation ('StarDist', 'Cellpose').
+        tile_size (int): Segment in tiles of this size (in resized pixels) to bound memory, or None.
+        cell_dtype (np.dtype): Dtype of the cell labels, np.uint16 or np.uint32.
+    
+    Returns:
+        List[dict]: The result of every container, as returned by `run_segmentor`.
+    """
+    pending = [container for container in containers if 'cell' not in container.images]
+    for container in containers:
+        if 'cell' in container.images:
+            logging.info(f"Skipping border segmentation for container '{container.name}', already exists.")
+    if not pending:
+        return [{} for _ in containers]
+    
+    container_keys = ', '.join(f"'{container.name}'" for container in pending)
+    logging.info(f"Running border segmentation for containers {container_keys}...")
+    segmenter = get_segmenter(model_type, tile_size=tile_size)
+    cell_masks = segmenter.run_batch(
+        input_imgs=[container.view('dug') for container in pending],
+        output_dtype=cell_dtype
+    )
+    logging.info(f"Border Segmentation completed for containers {container_keys}.")
+    
+    results = {container.name: {'cell': cell_mask} for container, cell_mask in zip(pending, cell_masks)}
+    return [results.get(container.name, {}) for container in containers]
+
+
+@tracing.traced('overlay')
+def run_overlay(container: ImageContainer) -> dict:
+    """
+    Draw the HER2 and Chr17 masks over the raw image of a single container.
+    Returns a dictionary with the overlay image.
+    """
+    container_key = container.name
+    
+    logging.info(f"Running Signal overlay for container '{container_key}'...")
+    overlay_img = overlay_signal(
+        image= container.view('raw'),
+        mask= container.view('her2'),
+        color= [0, 255, 0],
+        transparent= 0.5,
+    )
+    overlay_img = overlay_signal(
+        image= overlay_img,
+        mask= container.view('chr17'),
+        color= [0, 200, 255],
+        transparent= 0.5,
+    )
+    logging.info(f"Signal overlay completed for container '{container_key}'.")
+    
+    return {'overlay': overlay_img}
+
+
+@tracing.traced('score')
+def run_calculation(container: ImageContainer, name: str, heatmap_mode: str = 'exact') -> list:
     """
     Run the score calculation for a single container.
 
     Args:
         container (ImageContainer): The container with masks for cell, HER2, and Chr17.
+        name (str): Name recorded with every cell score.
+        heatmap_mode (str): Mode of the HER2 heatmap gating ('exact', 'decimated').
     
     Returns:
-        None
+        list: Cell scores of the container, sorted by descending score.
     """
     
     logging.info(f"Calculating cell score for container '{container.name}'...")
     # Calculate the cell score
     cell_score = calculate_all_score(
         name= name,
-        cell_mask=container.get('cell'),
-        her2_mask=container.get('her2'),
-        chr17_mask=container.get('chr17'),
+        cell_mask=container.view('cell'),
+        her2_mask=container.view('her2'),
+        chr17_mask=container.view('chr17'),
+        heatmap_mode=heatmap_mode,
     )
     logging.info(f"Cell score calculation completed for container '{container.name}'.")
     
     return cell_score
 
-def process_parallel(
-    cargo: CaseCargo,
-    her2_classifier_path: str,
-    chr17_classifier_path: str,
-    model_type: str,
-) -> None:
-    
-    container_keys = cargo.get_container_keys()
-    
-    from concurrent.futures import ProcessPoolExecutor
-    with ProcessPoolExecutor() as executor:
-        # Submit each container classification task and return results
-        classifier = {
-            key: executor.submit(
-                run_classifier,
-                cargo.get_container(key), 
-                her2_classifier_path, 
-                chr17_classifier_path,
-            )
-            for key in container_keys
-        }
-        
-        # Collect the results and update the cargo in the main process
-        for key, future in classifier.items():
-            result = future.result()
-            container = cargo.get_container(key)
-            if 'her2' in result:
-                container.add_image('her2', result['her2'])
-            if 'chr17' in result:
-                container.add_image('chr17', result['chr17'])
-            if 'dug' in result:
-                container.add_image('dug', result['dug'])
+
+def _output_specs(container: ImageContainer, labels: list, cell_dtype: np.dtype = np.uint16) -> dict:
+    """Return the shape and dtype of each layer in `labels` that the container is still missing."""
+    raw_shape, raw_dtype = container.layer_info('raw')
+    height, width = raw_shape[:2]
+    specs = {
+        'her2': ((height, width), np.uint16),
+        'chr17': ((height, width), np.uint16),
+        'dug': (raw_shape, raw_dtype),
+        'cell': ((height, width), cell_dtype),
+        'overlay': (raw_shape, raw_dtype),
+    }
+    return {label: specs[label] for label in labels if label not in container.images}
+
+
+def _run_shared(func, shared: SharedContainer, trace: bool, *args):
+    """
+    Run a stage in a worker on a shared-memory container.
+
+    Layers returned by the stage are written into the output blocks preallocated by the
+    main process and only their labels are sent back. Any other result is returned as is,
+    together with the tracing spans the worker recorded for the task.
+    """
+    tracing.enable(trace)
+    try:
+        result = func(shared, *args)
+        if isinstance(result, dict):
+            result = shared.publish(result)
+        return result, tracing.drain()
+    finally:
+        shared.close()
+
+
+def _run_shared_batch(func, shareds: List[SharedContainer], trace: bool, *args):
+    """
+    Run a batched stage in a worker on several shared-memory containers.
+
+    Like `_run_shared`, with one list of layer labels returned per container.
+    """
+    tracing.enable(trace)
+    try:
+        results = func(shareds, *args)
+        return [shared.publish(result) for shared, result in zip(shareds, results)], tracing.drain()
+    finally:
+        for shared in shareds:
+            shared.close()
+
+
+def _submit(pool: WorkerPool, func, container: ImageContainer, inputs: list, outputs: list, *args, cell_dtype: np.dtype = np.uint16):
+    """Share a container's layers with the pool and submit a stage on them."""
+    shared = container.share(inputs, _output_specs(container, outputs, cell_dtype))
+    return shared, pool.submit(_run_shared, func, shared, tracing.is_enabled(), *args)
+
+
+def _submit_batch(pool: WorkerPool, func, containers: List[ImageContainer], inputs: list, outputs: list, *args, cell_dtype: np.dtype = np.uint16):
+    """Share the layers of several containers with the pool and submit one batched stage on them."""
+    shareds = [container.share(inputs, _output_specs(container, outputs, cell_dtype)) for container in containers]
+    return shareds, pool.submit(_run_shared_batch, func, shareds, tracing.is_enabled(), *args)
+
+
+def _collect(container: ImageContainer, shared: SharedContainer, labels: List[str]) -> None:
+    """Add the layers a stage wrote to the container."""
+    try:
+        for label in labels:
+            container.add_image(label, shared.read(label))
+    finally:
+        shared.unlink_outputs()
+
+
+# Per-container task graph: each stage and the stages whose layers it needs.
+STAGE_DEPENDENCIES: Dict[str, List[str]] = {
+    'classify': [],
+    'dug': ['classify'],
+    'segment': ['dug'],
+    'overlay': ['classify'],
+    'score': ['classify', 'segment'],
+}
+
+
+class CaseGraph:
+    """
+    Schedules the per-container task graph of one case on a worker pool.
+
+    Every container moves to its next stage as soon as its own inputs are ready, so a slow
+    image never holds back the others. The cross-container ranking is merged once the last
+    score has arrived.
+
+    Every layer is identified by a hash chained from its stage parameters (classifier file,
+    feature settings, segmentation model and thresholds) and the hashes of the layers it was
+    computed from. A stage is skipped only when each of its saved layers carries the same
+    hash in the container manifest; stale layers are dropped and recomputed, and the new
+    hashes invalidate everything downstream of them.
+    """
+
+    def __init__(
+        self,
+        cargo: CaseCargo,
+        her2_classifier_path: str,
+        chr17_classifier_path: str,
+        model_type: str,
+        classifier_tile_size: int = None,
+        heatmap_mode: str = 'exact',
+        segmentation_tile_size: int = None,
+        segment_batch_size: int = 1,
+        cell_dtype: np.dtype = np.uint16,
+        signal_removal_method: str = 'fill',
+        signal_removal_tile_size: int = None,
+    ) -> None:
+        """
+        Args:
+            cargo (CaseCargo): The case to process.
+            her2_classifier_path (str): Path to the HER2 classifier.
+            chr17_classifier_path (str): Path to the Chr17 classifier.
+            model_type (str): Type of model to be used for segmentation ('StarDist', 'Cellpose').
+            classifier_tile_size (int): Tile size for classification, or None for whole images.
+            heatmap_mode (str): Mode of the HER2 heatmap gating ('exact', 'decimated').
+            segmentation_tile_size (int): Tile size for segmentation, or None for whole images.
+            segment_batch_size (int): Number of containers segmented together in one task.
+            cell_dtype (np.dtype): Dtype of the cell labels, np.uint16 or np.uint32.
+            signal_removal_method (str): How signals are removed before segmentation ('fill', 'inpaint').
+            signal_removal_tile_size (int): With 'fill', fill each tile of this size with its own
+                background color, or None for one color per image.
+        """
+        self.cargo = cargo
+        self.model_type = model_type
+        self.segmentation_tile_size = segmentation_tile_size
+        self.cell_dtype = cell_dtype
+        self.heatmap_mode = heatmap_mode
+        self.segment_batch_size = max(1, segment_batch_size)
+        self.container_keys = cargo.get_container_keys()
         
-        # Submit each container segmentation task and return results
-        segmentor = {
-            key: executor.submit(
-                run_segmentor,
-                cargo.get_container(key), 
-                model_type,
-            )
-            for key in container_keys
+        # Stage -> (function, layers it reads, layers it writes, extra arguments)
+        self.stages: Dict[str, tuple] = {
+            'classify': (run_classifier, ['raw', 'her2', 'chr17'], ['her2', 'chr17'], (her2_classifier_path, chr17_classifier_path, classifier_tile_size)),
+            'dug': (run_signal_removal, ['raw', 'her2', 'chr17'], ['dug'], (signal_removal_method, signal_removal_tile_size)),
+            'segment': (run_segmentor, ['dug'], ['cell'], (model_type, segmentation_tile_size, cell_dtype)),
+            'overlay': (run_overlay, ['raw', 'her2', 'chr17'], ['overlay'], ()),
+            'score': (run_calculation, ['cell', 'her2', 'chr17'], [], ()),
         }
         
-        # Collect the results and update the cargo in the main process
-        for key, future in segmentor.items():
-            result = future.result()
-            container = cargo.get_container(key)
-            if 'cell' in result:
-                container.add_image('cell', result['cell'])
-            if 'overlay' in result:
-                container.add_image('overlay', result['overlay'])
+        self.submitted: Dict[str, set] = {key: set() for key in self.container_keys}
+        self.completed: Dict[str, set] = {key: set() for key in self.container_keys}
+        # Future -> (stage, [(container key, shared container), ...], whether the stage is batched)
+        self.running: Dict[Future, Tuple[str, List[Tuple[str, SharedContainer]], bool]] = {}
+        self.scores: Dict[str, list] = {}
+        # Containers whose segmentation waits for a batch to fill up
+        self.segment_batch: List[str] = []
         
-        # Submit each container calculation task and return results  
-        calculator = {
-            key: executor.submit(
-                run_calculation,
-                cargo.get_container(key),
-                key,
-            )
-            for key in container_keys
+        # Parameters of every stage that writes layers, but segmentation, which depends on the image size
+        classifier_parameters = Classifier().parameters()
+        self.parameters: Dict[str, dict] = {
+            'her2': {'stage': 'classify', 'classifier': file_digest(her2_classifier_path), **classifier_parameters},
+            'chr17': {'stage': 'classify', 'classifier': file_digest(chr17_classifier_path), **classifier_parameters},
+            'dug': {
+                'stage': 'dug', **SIGNAL_REMOVAL_PARAMETERS,
+                'method': signal_removal_method, 'tile_size': signal_removal_tile_size,
+            },
+            'overlay': {'stage': 'overlay'},
         }
+        self.layer_hashes: Dict[str, Dict[str, str]] = {
+            key: self._layer_hashes(cargo.get_container(key)) for key in self.container_keys
+        }
+
+    def _layer_hashes(self, container: ImageContainer) -> Dict[str, str]:
+        """Chain the stage parameters along the task graph into a hash for every layer of a container."""
+        hashes = {'raw': stage_hash({'stage': 'raw', 'image': container.raw_digest})}
+        hashes['her2'] = stage_hash(self.parameters['her2'], hashes['raw'])
+        hashes['chr17'] = stage_hash(self.parameters['chr17'], hashes['raw'])
+        hashes['dug'] = stage_hash(self.parameters['dug'], hashes['raw'], hashes['her2'], hashes['chr17'])
+        # Tiling only counts for images large enough to be tiled; smaller ones give the same labels
+        cell_parameters = segmenter_parameters(
+            self.model_type, tile_size=self.segmentation_tile_size, shape=container.layer_info('raw')[0],
+        )
+        hashes['cell'] = stage_hash({'stage': 'segment', **cell_parameters}, hashes['dug'])
+        hashes['overlay'] = stage_hash(self.parameters['overlay'], hashes['raw'], hashes['her2'], hashes['chr17'])
+        return hashes
+
+    @property
+    def done(self) -> bool:
+        """Whether every stage of every container has completed."""
+        return all(len(stages) == len(STAGE_DEPENDENCIES) for stages in self.completed.values())
+
+    def submit_ready(self, pool: WorkerPool) -> List[Future]:
+        """Submit every stage whose dependencies are met and return the new futures."""
+        futures = []
+        for key in self.container_keys:
+            container = self.cargo.get_container(key)
+            progressed = True
+            while progressed:
+                progressed = False
+                for stage, dependencies in STAGE_DEPENDENCIES.items():
+                    if stage in self.submitted[key] or not self.completed[key].issuperset(dependencies):
+                        continue
+                    self.submitted[key].add(stage)
+                    
+                    func, inputs, outputs, args = self.stages[stage]
+                    hashes = self.layer_hashes[key]
+                    if outputs and all(container.is_current(label, hashes[label]) for label in outputs):
+                        logging.info(f"Skipping stage '{stage}' for container '{key}', already up to date.")
+                        self.completed[key].add(stage)
+                        progressed = True
+                        continue
+                    
+                    for label in outputs:
+                        if label in container.images and not container.is_current(label, hashes[label]):
+                            logging.info(f"Layer '{label}' of container '{key}' is out of date, recomputing.")
+                            container.invalidate(label)
+                    
+                    if stage == 'segment' and self.segment_batch_size > 1:
+                        self.segment_batch.append(key)
+                        continue
+                    if stage == 'score':
+                        args = (key, self.heatmap_mode)
+                    shared, future = _submit(pool, func, container, inputs, outputs, *args, cell_dtype=self.cell_dtype)
+                    self.running[future] = (stage, [(key, shared)], False)
+                    futures.append(future)
         
-        # Collect the results and update the cargo in the main process
-        sorted_results = [future.result() for future in calculator.values()]
+        futures.extend(self._submit_segment_batches(pool))
+        return futures
+
+    def _submit_segment_batches(self, pool: WorkerPool) -> List[Future]:
+        """
+        Submit the waiting segmentations in batches of `segment_batch_size`. A partial batch is
+        only submitted once no other container of the case can still join it.
+        """
+        futures = []
+        joining = any('segment' not in self.submitted[key] for key in self.container_keys)
+        while self.segment_batch and (len(self.segment_batch) >= self.segment_batch_size or not joining):
+            keys = self.segment_batch[:self.segment_batch_size]
+            del self.segment_batch[:self.segment_batch_size]
+            
+            _, inputs, outputs, args = self.stages['segment']
+            containers = [self.cargo.get_container(key) for key in keys]
+            shareds, future = _submit_batch(pool, run_segmentor_batch, containers, inputs, outputs, *args, cell_dtype=self.cell_dtype)
+            self.running[future] = ('segment', list(zip(keys, shareds)), True)
+            futures.append(future)
+        return futures
+
+    def complete(self, future: Future) -> None:
+        """Collect a finished stage into its container, raising if the stage failed."""
+        stage, members, batched = self.running.pop(future)
+        try:
+            result, spans = future.result()
+        except BaseException:
+            for _, shared in members:
+                shared.unlink_outputs()
+            raise
+        tracing.collect(spans)
         
-        import heapq
+        # A batched stage returns one result per container
+        for (key, shared), result in zip(members, result if batched else [result]):
+            if stage == 'score':
+                self.scores[key] = result
+            else:
+                container = self.cargo.get_container(key)
+                _collect(container, shared, result)
+                for label in self.stages[stage][2]:
+                    container.record(label, self.layer_hashes[key][label])
+            self.completed[key].add(stage)
+
+    def merge(self, top_k: int = None) -> None:
+        """Merge the per-container rankings into the case ranking, keeping its `top_k` best cells."""
+        self.cargo.scored_cells = sum(len(self.scores[key]) for key in self.container_keys)
+        self.cargo.all_cell_score = top_k_scores(
+            [self.scores[key] for key in self.container_keys],
+            k=top_k,
+        )
+
+    def abort(self) -> None:
+        """Cancel the stages that have not started and wait for the others to finish."""
+        for future in self.running:
+            future.cancel()
+        wait(list(self.running))
+        for _, members, _ in self.running.values():
+            for _, shared in members:
+                shared.unlink_outputs()
+        self.running.clear()
+
+    def release(self) -> None:
+        """Free the shared memory published by the containers of this case."""
+        for key in self.container_keys:
+            self.cargo.get_container(key).release_shared()
+
+
+def process_cases(
+    cargos: Iterable[CaseCargo],
+    her2_classifier_path: str,
+    chr17_classifier_path: str,
+    model_type: str,
+    pool: WorkerPool = None,
+    classifier_tile_size: int = None,
+    heatmap_mode: str = 'exact',
+    top_k: int = None,
+    on_case_done: Callable[[CaseCargo, Optional[BaseException]], None] = None,
+    max_cases: int = None,
+    segmentation_tile_size: int = None,
+    segment_batch_size: int = 1,
+    cell_dtype: np.dtype = np.uint16,
+    signal_removal_method: str = 'fill',
+    signal_removal_tile_size: int = None,
+) -> Dict[str, Optional[BaseException]]:
+    """
+    Run classification, segmentation and scoring for several cases on one worker pool.
+
+    The task graphs of all open cases are driven from a single wait loop, so the containers
+    of several small cases keep every worker busy instead of running case by case. A failing
+    case is aborted on its own; the other cases carry on.
+
+    Result layers are saved by background writer threads. Each case waits for its own writes
+    before it is reported, and a failed write fails that case. While the writers are behind,
+    new stages and cases are held back rather than blocking the loop.
+
+    Args:
+        cargos (Iterable[CaseCargo]): The cases to process. A generator is consumed lazily,
+            so a case is only loaded once there is room for it (see `max_cases`).
+        her2_classifier_path (str): Path to the HER2 classifier.
+        chr17_classifier_path (str): Path to the Chr17 classifier.
+        model_type (str): Type of model to be used for segmentation ('StarDist', 'Cellpose').
+        pool (WorkerPool): Warm pool to run the tasks on. If omitted, a pool is created
+            and shut down when every case has finished.
+        classifier_tile_size (int): If set, classify in tiles of this size to bound worker memory.
+        heatmap_mode (str): Mode of the HER2 heatmap gating ('exact', 'decimated').
+        top_k (int): Number of best cells kept in each `cargo.all_cell_score`, or None for all.
+        on_case_done (Callable): Called in the calling thread as `on_case_done(cargo, error)` as
+            soon as a case has finished, with `error` None on success, e.g. to write its report.
+            An exception it raises is logged and recorded as the error of that case only.
+        max_cases (int): Maximum number of cases in flight at once, or None for no limit.
+        segmentation_tile_size (int): If set, segment in tiles of this size (in resized pixels),
+            stitching the labels, to bound worker memory on large scans.
+        segment_batch_size (int): Number of containers of a case segmented together in one task,
+            e.g. so Cellpose evaluates them in one call. 1 segments every container on its own.
+        cell_dtype (np.dtype): Dtype of the cell labels. np.uint16 holds up to 65535 cells per
+            image; use np.uint32 for denser scans, which otherwise fail with a ValueError.
+        signal_removal_method (str): 'fill' (default) paints the background color over the
+            signals, 'inpaint' fills them from their surroundings, see `tools.remove_signal`.
+        signal_removal_tile_size (int): With 'fill', use the background color of each tile of
+            this size, which follows uneven staining. None uses one color per image.
+
+    Returns:
+        Dict[str, Optional[BaseException]]: Error of every case keyed by its input path, None on success.
+    """
+    own_pool = pool is None
+    if own_pool:
+        pool = WorkerPool(her2_classifier_path, chr17_classifier_path, model_type)
+    
+    # Layers are saved in the background while the workers move on to the next stages
+    writer = LayerWriter()
+    pending = iter(cargos)
+    exhausted = False
+    active: List[CaseGraph] = []
+    # Cases whose next stages wait for the writer to catch up
+    held: List[CaseGraph] = []
+    owners: Dict[Future, CaseGraph] = {}
+    errors: Dict[str, Optional[BaseException]] = {}
+    
+    def finish(graph: CaseGraph, error: Optional[BaseException]) -> None:
+        """Merge or abort a finished case, wait for its layer writes, free its shared memory and report it."""
+        if error is None:
+            try:
+                graph.merge(top_k)
+            except Exception as e:
+                error = e
+        if graph in held:
+            held.remove(graph)
+        if error is not None:
+            for future in graph.running:
+                owners.pop(future, None)
+            graph.abort()
+        # A case is only reported once every layer it produced is on disk
+        try:
+            graph.cargo.flush()
+        except Exception as e:
+            error = error or e
+        graph.cargo.set_writer(None)
+        if error is not None:
+            logging.error(f"Processing failed for case '{graph.cargo.input_path}': {error}")
+        graph.release()
+        try:
+            graph.cargo.save_layer_index()
+        except OSError as e:
+            logging.error(f"Could not write layer index of case '{graph.cargo.input_path}': {e}")
+        active.remove(graph)
+        report(graph.cargo, error)
+    
+    def report(cargo: CaseCargo, error: Optional[BaseException]) -> None:
+        """Record the outcome of a case and pass it to `on_case_done`, whose failures only fail that case."""
+        errors[str(cargo.input_path)] = error
+        if on_case_done is None:
+            return
+        try:
+            on_case_done(cargo, error)
+        except Exception as e:
+            logging.exception(f"Case callback failed for case '{cargo.input_path}': {e}")
+            errors[str(cargo.input_path)] = error or e
+    
+    def submit(graph: CaseGraph) -> None:
+        """
+        Submit the ready stages of a case, finishing it if nothing is left to run. While the
+        writer is saturated the case is held back instead, so results cannot pile up in memory.
+        """
+        if writer.saturated:
+            if graph not in held:
+                held.append(graph)
+            return
+        try:
+            for future in graph.submit_ready(pool):
+                owners[future] = graph
+        except Exception as e:
+            finish(graph, e)
+            return
+        if not graph.running:
+            finish(graph, None)
+    
+    try:
+        while True:
+            # Resume the held cases once the writer has caught up
+            while held and not writer.saturated:
+                submit(held.pop(0))
+            
+            # Open new cases while there is room for them
+            while not exhausted and not writer.saturated and (max_cases is None or len(active) < max_cases):
+                cargo = next(pending, None)
+                if cargo is None:
+                    exhausted = True
+                    break
+                try:
+                    graph = CaseGraph(
+                        cargo, her2_classifier_path, chr17_classifier_path, model_type,
+                        classifier_tile_size, heatmap_mode, segmentation_tile_size, segment_batch_size,
+                        cell_dtype, signal_removal_method, signal_removal_tile_size,
+                    )
+                except Exception as e:
+                    logging.error(f"Processing failed for case '{cargo.input_path}': {e}")
+                    report(cargo, e)
+                    continue
+                cargo.set_writer(writer)
+                active.append(graph)
+                submit(graph)
+            
+            if not owners and not held and (exhausted or not writer.saturated):
+                break
+            
+            # Wake up for a finished stage, or for a finished write while cases are held back
+            blocked = held or (not exhausted and writer.saturated)
+            waiting = list(owners) + (writer.pending() if blocked else [])
+            finished, _ = wait(waiting, return_when=FIRST_COMPLETED)
+            for future in finished:
+                graph = owners.pop(future, None)
+                if graph is None:
+                    # A layer write, or a stage of a case aborted while it was finishing
+                    continue
+                try:
+                    graph.complete(future)
+                except Exception as e:
+                    finish(graph, e)
+                    continue
+                submit(graph)
+    except BaseException:
+        for graph in active:
+            graph.abort()
+        raise
+    finally:
+        for graph in active:
+            graph.release()
+            graph.cargo.set_writer(None)
+        writer.shutdown()
+        if own_pool:
+            pool.shutdown()
+    
+    return errors
 
-        # Perform a k-way merge using heapq.merge()
-        sorted_temp = list(heapq.merge(*sorted_results, key=lambda x: -float(x[1])))
 
-        # Convert back to a NumPy array if needed
-        cargo.all_cell_score = np.array(sorted_temp)
\ No newline at end of file
+def process_parallel(
+    cargo: CaseCargo,
+    her2_classifier_path: str,
+    chr17_classifier_path: str,
+    model_type: str,
+    pool: WorkerPool = None,
+    classifier_tile_size: int = None,
+    heatmap_mode: str = 'exact',
+    top_k: int = None,
+    segmentation_tile_size: int = None,
+    segment_batch_size: int = 1,
+    cell_dtype: np.dtype = np.uint16,
+    signal_removal_method: str = 'fill',
+    signal_removal_tile_size: int = None,
+) -> None:
+    """
+    Run classification, segmentation and scoring for every container of a case.
+
+    Each container follows its own task graph (see `STAGE_DEPENDENCIES`), and layers
+    are exchanged with the workers through shared memory, so only small handles are
+    pickled for each task. To process several cases at once, use `process_cases`.
+
+    Args:
+        cargo (CaseCargo): The case to process.
+        her2_classifier_path (str): Path to the HER2 classifier.
+        chr17_classifier_path (str): Path to the Chr17 classifier.
+        model_type (str): Type of model to be used for segmentation ('StarDist', 'Cellpose').
+        pool (WorkerPool): Warm pool to run the tasks on. If omitted, a pool is created
+            for this case and shut down when it finishes.
+        classifier_tile_size (int): If set, classify in tiles of this size to bound worker memory.
+        heatmap_mode (str): 'exact' (default) or 'decimated' for the faster approximate HER2
+            heatmap gating, see `anaylsis.decimated_gaussian`.
+        top_k (int): Number of best cells kept in `cargo.all_cell_score`, or None to keep
+            every cell. The ranking is a structured array, see `anaylsis.top_k_scores`.
+        segmentation_tile_size (int): If set, segment in tiles of this size (in resized pixels),
+            stitching the labels, to bound worker memory on large scans.
+        segment_batch_size (int): Number of containers segmented together in one task.
+        cell_dtype (np.dtype): Dtype of the cell labels, np.uint16 or np.uint32.
+        signal_removal_method (str): 'fill' (default) paints the background color over the
+            signals, 'inpaint' fills them from their surroundings, see `tools.remove_signal`.
+        signal_removal_tile_size (int): With 'fill', use the background color of each tile of this size.
+    """
+    errors = process_cases(
+        [cargo], her2_classifier_path, chr17_classifier_path, model_type,
+        pool=pool,
+        classifier_tile_size=classifier_tile_size,
+        heatmap_mode=heatmap_mode,
+        top_k=top_k,
+        segmentation_tile_size=segmentation_tile_size,
+        segment_batch_size=segment_batch_size,
+        cell_dtype=cell_dtype,
+        signal_removal_method=signal_removal_method,
+        signal_removal_tile_size=signal_removal_tile_size,
+    )
+    error = errors[str(cargo.input_path)]
+    if error is not None:
+        raise error
@@ -1,16 +1,21 @@
 import numpy as np
 
+from typing import List, Tuple, Union
+
 class Segment:
     """
     A class for performing image segmentation using either the StarDist or Cellpose models.
     
+    A lightweight 'Threshold' backend, which needs no model weights, is available as an
+    offline stand-in for tests and benchmarks.
+    
     This class encapsulates the functionality required to segment images of cells or nuclei
     in microscopy data. It provides options to preprocess images by removing specific signals,
     resizing, and normalizing before feeding them into the segmentation models. The segmentation
     can be performed using either the StarDist or Cellpose models, based on the user's choice.
     
     Attributes:
-        model_type (str): Type of the model to use ('StarDist' or 'Cellpose').
+        model_type (str): Type of the model to use ('StarDist', 'Cellpose' or 'Threshold').
         remove_signal (bool): Whether to remove specific signals from the image.
         resize_scale (float): Scale factor for resizing the image.
         
@@ -25,6 +30,12 @@ class Segment:
         flow_threshold (float): Flow threshold parameter for Cellpose.
         cellprob_threshold (float): Cell probability threshold for Cellpose.
         
+        threshold_sigma (float): Gaussian smoothing applied before thresholding.
+        threshold_min_area (int): Smallest object kept by the threshold backend, in resized pixels.
+        
+        tile_size (int): Side of the tiles segmented one at a time, in resized pixels, or None.
+        tile_overlap (int): Context added around each tile, in resized pixels.
+        
         model: Loaded segmentation model instance (StarDist or Cellpose).
     """
 
@@ -43,12 +54,20 @@ class Segment:
         cellpose_channels: list = [0, 0],
         cellpose_flow_threshold: float = 3,
         cellpose_cellprob_threshold: float = -2,
+        
+        threshold_sigma: float = 1,
+        threshold_min_area: int = 20,
+        
+        tile_size: int = None,
+        tile_overlap: int = 64,
+        
+        load_model: bool = True,
     ) -> None:
         '''
         Initializes the Segment class with specified parameters.
         
         Parameters:
-            model_type (str): Type of the model to use ('StarDist' or 'Cellpose').
+            model_type (str): Type of the model to use ('StarDist', 'Cellpose' or 'Threshold').
             remove_signal (bool): Whether to remove specific signals from the image.
             resize_scale (float): Scale factor for resizing the image.
             
@@ -62,6 +81,18 @@ class Segment:
             cellpose_channels (list): Channels to use for Cellpose ([0,0] for grayscale).
             cellpose_flow_threshold (float): Flow threshold parameter for Cellpose.
             cellprob_threshold (float): Cell probability threshold for Cellpose.
+            
+            threshold_sigma (float): Gaussian smoothing applied before thresholding.
+            threshold_min_area (int): Smallest object kept by the threshold backend, in resized pixels.
+            
+            tile_size (int): If set, images larger than this (after resizing) are segmented in tiles
+                of this size, which bounds the memory of the model. StarDist tiles internally;
+                the other backends use `run_tiled`. None segments the whole image at once.
+            tile_overlap (int): Context added around each tile, in resized pixels. It should exceed
+                the largest nucleus radius, so every nucleus is seen whole by the tile that keeps it.
+            
+            load_model (bool): Whether to load the model weights. Without them the instance can
+                only describe its parameters.
         '''
         # Store initialization parameters
         self.model_type = model_type
@@ -78,16 +109,32 @@ class Segment:
         self.flow_threshold = cellpose_flow_threshold
         self.cellprob_threshold = cellpose_cellprob_threshold
         
-        from filelock import FileLock
+        self.threshold_sigma = threshold_sigma
+        self.threshold_min_area = threshold_min_area
         
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        
+        if self.model_type not in ('StarDist', 'Cellpose', 'Threshold'):
+            # Raise an error if an unsupported model_type is provided
+            raise ValueError(f"Unsupported model_type: {self.model_type}")
+        
+        self.model = None
+        if load_model:
+            self._load_model()
+
+    def _load_model(self) -> None:
+        """Load the pretrained weights of the selected segmentation model."""
         # Load the appropriate segmentation model based on model_type
         if self.model_type == 'StarDist':
+            from filelock import FileLock
             from stardist.models import StarDist2D
             # Use a file lock to prevent concurrent access to the model weights
             with FileLock("stardist_model.lock"):  # Lock file ensures only one process loads the model at a time
                 # Load a pretrained StarDist2D model
                 self.model = StarDist2D.from_pretrained(self.stardist_model_name)
         elif self.model_type == 'Cellpose':
+            from filelock import FileLock
             from cellpose import models
             with FileLock("cellpose_model.lock"):
                 # Initialize a CellposeModel with specified parameters
@@ -95,9 +142,56 @@ class Segment:
                     gpu=self.cellpose_gpu, 
                     model_type=self.cellpose_model_name,
                 )
-        else:
-            # Raise an error if an unsupported model_type is provided
-            raise ValueError(f"Unsupported model_type: {self.model_type}")
+
+    def is_tiled(self, shape: Tuple[int, ...]) -> bool:
+        """
+        Returns whether an image is segmented in tiles, i.e. whether it is larger than a tile once resized.
+        
+        Parameters:
+            shape (tuple): Shape of the input image, before resizing.
+        
+        Returns:
+            bool: True if the image is segmented tile by tile.
+        """
+        if not self.tile_size:
+            return False
+        return max(int(shape[0] * self.resize_scale), int(shape[1] * self.resize_scale)) > self.tile_size
+
+    def parameters(self, shape: Tuple[int, ...] = None) -> dict:
+        """
+        Returns the settings that determine the segmentation result, e.g. for cache invalidation.
+        
+        Parameters:
+            shape (tuple): Shape of the image the result is for. The tile settings are only
+                included if that image is segmented in tiles, since a smaller image is segmented
+                whole and gives the same labels either way. None includes them whenever tiling is on.
+        
+        Returns:
+            dict: Model type, resize scale and the settings of the selected backend.
+        """
+        parameters = {'model_type': self.model_type, 'resize_scale': self.resize_scale}
+        if self.model_type == 'StarDist':
+            parameters.update(
+                model_name=self.stardist_model_name,
+                prob_thresh=self.stardist_prob_thresh,
+                nms_thresh=self.stardist_nms_thresh,
+            )
+        elif self.model_type == 'Cellpose':
+            parameters.update(
+                model_name=self.cellpose_model_name,
+                diameter=self.cellpose_diameter,
+                channels=list(self.cellpose_channels),
+                flow_threshold=self.flow_threshold,
+                cellprob_threshold=self.cellprob_threshold,
+            )
+        elif self.model_type == 'Threshold':
+            parameters.update(
+                sigma=self.threshold_sigma,
+                min_area=self.threshold_min_area,
+            )
+        if self.tile_size if shape is None else self.is_tiled(shape):
+            parameters.update(tile_size=self.tile_size, tile_overlap=self.tile_overlap)
+        return parameters
 
     def run(
         self,
@@ -109,45 +203,90 @@ class Segment:
         
         Parameters:
             img (np.ndarray): The input image to segment.
-            her2_mask (np.ndarray): Mask for HER2 signal to remove.
-            chr17_mask (np.ndarray): Mask for Chr17 signal to remove.
+            output_dtype (np.dtype): Integer dtype of the returned labels, e.g. np.uint16 or np.uint32.
         
         Returns:
-            Tuple[np.ndarray, np.ndarray]: A tuple containing the normalized image and the segmentation mask.
+            np.ndarray: The segmentation mask, with consecutive labels.
         """
-        from cv2 import resize, INTER_AREA, INTER_NEAREST
-        from csbdeep.utils import normalize
+        return self.run_batch([input_img], output_dtype=output_dtype)[0]
+
+    def run_batch(
+        self,
+        input_imgs: List[np.ndarray],
+        output_dtype: str = np.uint16,
+    ) -> List[np.ndarray]:
+        """
+        Executes the segmentation pipeline on several images with the loaded model.
         
-        # Store the original image dimensions
-        old_width = int(input_img.shape[1])
-        old_height = int(input_img.shape[0])
+        Cellpose evaluates every image that fits in a tile in a single call; StarDist and the
+        threshold backend segment the images in turn, reusing the loaded model. Each image gives
+        the same mask as `run`.
         
-        # Calculate the new dimensions based on the resize scale
-        new_width = int(input_img.shape[1] * self.resize_scale)
-        new_height = int(input_img.shape[0] * self.resize_scale)
+        Parameters:
+            input_imgs (List[np.ndarray]): The input images to segment.
+            output_dtype (np.dtype): Integer dtype of the returned labels, e.g. np.uint16 or np.uint32.
         
-        # Resize the image to reduce computation time and memory usage
-        img_resized = resize(input_img, (new_width, new_height), interpolation=INTER_AREA)
+        Returns:
+            List[np.ndarray]: The segmentation mask of every image, in order.
+        """
+        from cv2 import resize, INTER_AREA, INTER_NEAREST
+        from csbdeep.utils import normalize
         
-        # Normalize the resized image to enhance contrast for segmentation
-        img_normalized = normalize(img_resized, 1, 99.8)
+        # Images larger than a tile are segmented tile by tile (StarDist tiles internally)
+        tiled = [self.is_tiled(input_img.shape) for input_img in input_imgs]
+
+        imgs_normalized = []
+        for input_img in input_imgs:
+            # Calculate the new dimensions based on the resize scale
+            new_width = int(input_img.shape[1] * self.resize_scale)
+            new_height = int(input_img.shape[0] * self.resize_scale)
+            
+            # Resize the image to reduce computation time and memory usage
+            img_resized = resize(input_img, (new_width, new_height), interpolation=INTER_AREA)
+            
+            # Normalize the resized image to enhance contrast for segmentation
+            imgs_normalized.append(normalize(img_resized, 1, 99.8))
 
         # Perform segmentation using the selected model
         if self.model_type == 'StarDist':
             # Run the StarDist segmentation method
-            mask = self.run_stardist(img_normalized)
+            masks = [self.run_stardist(img) for img in imgs_normalized]
         elif self.model_type == 'Cellpose':
-            # Run the Cellpose segmentation method
-            mask = self.run_cellpose(img_normalized)
+            # Run the Cellpose segmentation method, on all whole images at once
+            masks = [None] * len(imgs_normalized)
+            whole = [idx for idx, is_tiled in enumerate(tiled) if not is_tiled]
+            if whole:
+                for idx, mask in zip(whole, self.run_cellpose([imgs_normalized[idx] for idx in whole])):
+                    masks[idx] = mask
+            for idx, is_tiled in enumerate(tiled):
+                if is_tiled:
+                    masks[idx] = self.run_tiled(imgs_normalized[idx], self.run_cellpose)
+        elif self.model_type == 'Threshold':
+            # Run the model-free threshold segmentation
+            masks = [
+                self.run_tiled(img, self.run_threshold) if is_tiled else self.run_threshold(img)
+                for img, is_tiled in zip(imgs_normalized, tiled)
+            ]
         else:
             # Raise an error if an unsupported model_type is encountered
             raise ValueError(f"Unsupported model_type: {self.model_type}")
 
-        # Resize the segmentation mask back to the original image dimensions
-        mask_resized = resize(mask, (old_width, old_height), interpolation=INTER_NEAREST).astype(np.uint16)
+        masks_resized = []
+        for input_img, mask in zip(input_imgs, masks):
+            mask = np.asarray(mask)
+            
+            # Labels must fit the output dtype instead of silently wrapping around
+            count = int(mask.max()) if mask.size else 0
+            if count > np.iinfo(output_dtype).max:
+                raise ValueError(f"{count} labels do not fit in {np.dtype(output_dtype).name}, use a wider output_dtype.")
+
+            # Resize the segmentation mask back to the original image dimensions
+            old_height, old_width = input_img.shape[:2]
+            mask_resized = resize(mask.astype(np.int32, copy=False), (old_width, old_height), interpolation=INTER_NEAREST)
+            masks_resized.append(mask_resized.astype(output_dtype))
         
-        # Return the normalized image and the resized segmentation mask
-        return mask_resized.astype(output_dtype)
+        # Return the resized segmentation masks
+        return masks_resized
 
     def run_stardist(self, img: np.ndarray) -> np.ndarray:
         """
@@ -161,25 +300,32 @@ class Segment:
         """
         from skimage.segmentation import expand_labels
         
+        # Let StarDist predict in tiles, which it stitches itself, when the image exceeds a tile
+        n_tiles = None
+        if self.tile_size and max(img.shape[:2]) > self.tile_size:
+            n_tiles = tuple(-(-size // self.tile_size) for size in img.shape[:2]) + (1,) * (img.ndim - 2)
+        
         # Predict instances using the StarDist model with specified thresholds
         mask, _ = self.model.predict_instances(
             img=img,
             prob_thresh=self.stardist_prob_thresh,
             nms_thresh=self.stardist_nms_thresh,
+            n_tiles=n_tiles,
         )
         # Expand the labels in the mask to cover neighboring pixels
         mask = expand_labels(mask, distance=2)
         return mask
 
-    def run_cellpose(self, img: np.ndarray) -> np.ndarray:
+    def run_cellpose(self, img: Union[np.ndarray, List[np.ndarray]]) -> Union[np.ndarray, List[np.ndarray]]:
         """
         Performs segmentation using the Cellpose model.
         
         Parameters:
-            img (np.ndarray): The preprocessed and normalized image.
+            img (np.ndarray or List[np.ndarray]): The preprocessed and normalized image, or a list
+                of images evaluated in one call.
         
         Returns:
-            np.ndarray: The segmentation mask produced by Cellpose.
+            np.ndarray or List[np.ndarray]: The segmentation mask produced by Cellpose, or one mask per image.
         """
         # Evaluate the image using the Cellpose model with specified parameters
         mask, _, _ = self.model.eval(
@@ -189,4 +335,101 @@ class Segment:
             flow_threshold=self.flow_threshold,
             cellprob_threshold=self.cellprob_threshold,
         )
-        return mask
\ No newline at end of file
+        return mask
+
+    def run_threshold(self, img: np.ndarray) -> np.ndarray:
+        """
+        Performs segmentation by Otsu thresholding, as a stand-in that needs no model weights.
+        
+        Dark, hematoxylin-stained nuclei are separated from the bright background, holes are
+        filled, small objects are dropped and the remaining components are labeled.
+        
+        Parameters:
+            img (np.ndarray): The preprocessed and normalized image.
+        
+        Returns:
+            np.ndarray: The labeled segmentation mask.
+        """
+        from scipy import ndimage
+        from skimage.filters import threshold_otsu
+        from skimage.segmentation import expand_labels
+        
+        # Collapse the channels and smooth out the signal dots
+        gray = img.mean(axis=-1) if img.ndim == 3 else img
+        gray = ndimage.gaussian_filter(gray.astype(np.float32), sigma=self.threshold_sigma)
+        
+        # Nuclei are darker than the background
+        foreground = ndimage.binary_fill_holes(gray < threshold_otsu(gray))
+        mask, count = ndimage.label(foreground)
+        
+        # Drop objects smaller than the minimum area and relabel the rest consecutively
+        areas = np.bincount(mask.ravel(), minlength=count + 1)
+        keep = areas >= self.threshold_min_area
+        keep[0] = False
+        lookup = np.zeros(count + 1, dtype=np.int32)
+        lookup[keep] = np.arange(1, int(keep.sum()) + 1)
+        mask = lookup[mask]
+        
+        # Expand the labels in the mask to cover neighboring pixels
+        return expand_labels(mask, distance=2)
+
+    def run_tiled(self, img: np.ndarray, segment) -> np.ndarray:
+        """
+        Segments an image tile by tile and stitches the tiles into one label image.
+        
+        Each tile is segmented with `tile_overlap` pixels of context on every side. An object
+        belongs to the tile whose core (the tile without its context) contains its centroid, so
+        a nucleus cut by a tile border is taken whole from the tile that sees it whole, and never
+        twice. Kept objects are relabeled consecutively; pixels already claimed by an object of
+        an earlier tile are left to it. Memory is bounded by the tile size, not the image size.
+        
+        Parameters:
+            img (np.ndarray): The preprocessed and normalized image.
+            segment (Callable): Segments one tile, e.g. `self.run_cellpose`.
+        
+        Returns:
+            np.ndarray: The stitched int32 segmentation mask.
+        """
+        height, width = img.shape[:2]
+        tile, overlap = self.tile_size, self.tile_overlap
+        stitched = np.zeros((height, width), dtype=np.int32)
+        count = 0
+        
+        for y in range(0, height, tile):
+            for x in range(0, width, tile):
+                top, left = max(0, y - overlap), max(0, x - overlap)
+                bottom, right = min(height, y + tile + overlap), min(width, x + tile + overlap)
+                labels = np.asarray(segment(img[top:bottom, left:right]))
+                n = int(labels.max())
+                if n == 0:
+                    continue
+                
+                # Centroid of every object of the tile, in image coordinates
+                rows, cols = np.nonzero(labels)
+                ids = labels[rows, cols]
+                areas = np.bincount(ids, minlength=n + 1)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    centroid_y = np.bincount(ids, weights=rows, minlength=n + 1) / areas + top
+                    centroid_x = np.bincount(ids, weights=cols, minlength=n + 1) / areas + left
+                
+                # Keep the objects centred in the core of this tile
+                owned = (areas > 0) & (centroid_y >= y) & (centroid_y < y + tile) & (centroid_x >= x) & (centroid_x < x + tile)
+                owned[0] = False
+                kept = int(owned.sum())
+                lookup = np.zeros(n + 1, dtype=np.int32)
+                lookup[owned] = np.arange(count + 1, count + kept + 1)
+                count += kept
+                
+                relabeled = lookup[labels]
+                region = stitched[top:bottom, left:right]
+                np.copyto(region, relabeled, where=(relabeled != 0) & (region == 0))
+        
+        # Close the gaps left by objects whose pixels were all claimed by earlier tiles
+        present = np.bincount(stitched.ravel(), minlength=count + 1) > 0
+        present[0] = False
+        if present.sum() < count:
+            lookup = np.zeros(count + 1, dtype=np.int32)
+            lookup[present] = np.arange(1, int(present.sum()) + 1)
+            stitched = lookup[stitched]
+        
+        return stitched
@@ -0,0 +1,256 @@
+import numpy as np
+
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, Tuple, Type, Union
+
+# Window of a layer as (y0, y1, x0, x1), in pixels.
+Window = Tuple[int, int, int, int]
+
+# NumPy dtype of the arrays Pillow returns for each image mode.
+PIL_MODE_DTYPES: Dict[str, str] = {
+    '1': 'bool', 'L': 'uint8', 'P': 'uint8', 'RGB': 'uint8', 'RGBA': 'uint8', 'CMYK': 'uint8',
+    'I;16': 'uint16', 'I;16B': 'uint16', 'I;16L': 'uint16', 'I': 'int32', 'F': 'float32',
+}
+
+
+def clamp_window(window: Window, height: int, width: int) -> Window:
+    """
+    Clip a window to an image of the given size. A window outside the image becomes empty.
+
+    Args:
+        window (Window): Rows y0:y1 and columns x0:x1, which may extend past the image.
+        height (int): Image height.
+        width (int): Image width.
+
+    Returns:
+        Window: The clipped window, with 0 <= y0 <= y1 <= height and 0 <= x0 <= x1 <= width.
+    """
+    y0, y1, x0, x1 = window
+    y0, x0 = min(max(0, y0), height), min(max(0, x0), width)
+    return y0, max(y0, min(height, y1)), x0, max(x0, min(width, x1))
+
+
+def probe_image(path: Union[str, Path]) -> Tuple[Tuple[int, ...], str]:
+    """
+    Read the shape and dtype of an image file with Pillow, from its header only.
+
+    Args:
+        path (str or Path): Image file.
+
+    Returns:
+        Tuple[Tuple[int, ...], str]: Shape and dtype name of the array the image decodes to.
+    """
+    from PIL import Image
+
+    with Image.open(path) as img:
+        bands = len(img.getbands())
+        shape = (img.height, img.width) if bands == 1 else (img.height, img.width, bands)
+        return shape, PIL_MODE_DTYPES.get(img.mode, 'uint8')
+
+
+class LayerStore(ABC):
+    """
+    Reads and writes the derived layers of a container, one file per layer.
+
+    Subclasses decide the on-disk format; the file names are chosen by the container.
+    """
+
+    name: str = None
+
+    @abstractmethod
+    def save(self, path: Union[str, Path], array: np.ndarray, binary: bool = False) -> None:
+        """
+        Write a layer.
+
+        Args:
+            path (str or Path): Output file.
+            array (np.ndarray): Layer to write.
+            binary (bool): Hint that the layer is a two-valued mask, which may be stored packed.
+        """
+
+    @abstractmethod
+    def load(self, path: Union[str, Path]) -> np.ndarray:
+        """Read a whole layer, with the dtype and values it was saved with."""
+
+    def probe(self, path: Union[str, Path]) -> Tuple[Tuple[int, ...], str]:
+        """Return the shape and dtype name of a layer without decoding its pixels."""
+        return probe_image(path)
+
+    def read_window(self, path: Union[str, Path], window: Window) -> np.ndarray:
+        """
+        Read part of a layer.
+
+        Args:
+            path (str or Path): Layer file.
+            window (Window): Rows y0:y1 and columns x0:x1 to read.
+
+        Returns:
+            np.ndarray: The window clipped to the layer (see `clamp_window`), with the dtype and
+            values the layer was saved with.
+        """
+        array = self.load(path)
+        y0, y1, x0, x1 = clamp_window(window, *array.shape[:2])
+        return array[y0:y1, x0:x1]
+
+
+class PillowStore(LayerStore):
+    """Uncompressed TIFF files written by Pillow, the original layer format."""
+
+    name = 'pil'
+
+    def save(self, path: Union[str, Path], array: np.ndarray, binary: bool = False) -> None:
+        from PIL import Image
+
+        Image.fromarray(array).save(path)
+
+    def load(self, path: Union[str, Path]) -> np.ndarray:
+        from PIL import Image
+
+        with Image.open(path) as img:
+            return np.array(img)
+
+
+class TiledTiffStore(LayerStore):
+    """
+    Tiled, deflate-compressed TIFF files.
+
+    Two-valued masks, such as the HER2 and Chr17 layers (0 or 65535 in uint16), are stored as
+    1-bit images. Their original dtype and foreground value are kept in the TIFF description,
+    so they load back unchanged. Windowed reads decode only the tiles they overlap. Files from
+    `PillowStore` and other plain TIFFs are read as well, so existing outputs keep working.
+    """
+
+    name = 'tiff'
+
+    def __init__(self, tile: int = 256, level: int = 6) -> None:
+        """
+        Args:
+            tile (int): Side of the square tiles, a multiple of 16.
+            level (int): Deflate compression level (1 fastest, 9 smallest).
+        """
+        self.tile = tile
+        self.level = level
+
+    def save(self, path: Union[str, Path], array: np.ndarray, binary: bool = False) -> None:
+        import tifffile
+
+        metadata = None
+        if binary and array.ndim == 2 and np.issubdtype(array.dtype, np.integer):
+            on_value = array.max()
+            if on_value != 0 and not np.any((array != 0) & (array != on_value)):
+                metadata = {'dtype': array.dtype.str, 'on_value': int(on_value)}
+                array = array != 0
+
+        tifffile.imwrite(
+            path,
+            array,
+            tile=(self.tile, self.tile),
+            compression='zlib',
+            compressionargs={'level': self.level},
+            photometric='rgb' if array.ndim == 3 and array.shape[2] in (3, 4) else 'minisblack',
+            metadata=metadata,
+        )
+
+    def load(self, path: Union[str, Path]) -> np.ndarray:
+        import tifffile
+
+        with tifffile.TiffFile(path) as tif:
+            page = tif.pages[0]
+            return self._unpack(page.asarray(), tif)
+
+    def probe(self, path: Union[str, Path]) -> Tuple[Tuple[int, ...], str]:
+        import tifffile
+
+        with tifffile.TiffFile(path) as tif:
+            page = tif.pages[0]
+            dtype = page.dtype.name
+            if dtype == 'bool':
+                metadata = (tif.shaped_metadata or ({},))[0]
+                dtype = np.dtype(metadata.get('dtype', np.uint8)).name
+            return tuple(page.shape), dtype
+
+    def read_window(self, path: Union[str, Path], window: Window) -> np.ndarray:
+        import tifffile
+
+        with tifffile.TiffFile(path) as tif:
+            page = tif.pages[0]
+            y0, y1, x0, x1 = clamp_window(window, *page.shape[:2])
+            height, width = page.shape[:2]
+
+            if not page.is_tiled:
+                # Striped files, e.g. written by Pillow, are read whole
+                return self._unpack(page.asarray()[y0:y1, x0:x1], tif)
+
+            tile_height, tile_width = page.tilelength, page.tilewidth
+            tiles_across = -(-width // tile_width)
+            indices = [
+                row * tiles_across + col
+                for row in range(y0 // tile_height, -(-y1 // tile_height))
+                for col in range(x0 // tile_width, -(-x1 // tile_width))
+            ]
+
+            samples = page.shape[2:] if len(page.shape) > 2 else ()
+            out = np.empty((y1 - y0, x1 - x0, *samples), dtype=page.dtype)
+            for data, index in tif.filehandle.read_segments(
+                [page.dataoffsets[i] for i in indices],
+                [page.databytecounts[i] for i in indices],
+                indices=indices,
+            ):
+                segment, (_, _, tile_y, tile_x, _), _ = page.decode(data, index)
+                segment = segment[0] if samples else segment[0, ..., 0]
+
+                # Overlap of the tile with the window, in image coordinates
+                top, bottom = max(y0, tile_y), min(y1, tile_y + tile_height)
+                left, right = max(x0, tile_x), min(x1, tile_x + tile_width)
+                out[top - y0:bottom - y0, left - x0:right - x0] = \
+                    segment[top - tile_y:bottom - tile_y, left - tile_x:right - tile_x]
+
+            return self._unpack(out, tif)
+
+    @staticmethod
+    def _unpack(array: np.ndarray, tif) -> np.ndarray:
+        """Restore a 1-bit mask to the dtype and foreground value it was saved with."""
+        if array.dtype != bool:
+            return array
+        metadata = (tif.shaped_metadata or ({},))[0]
+        dtype = np.dtype(metadata.get('dtype', np.uint8))
+        on_value = metadata.get('on_value', 1)
+        return np.where(array, dtype.type(on_value), dtype.type(0))
+
+
+# Stores selectable by name, e.g. from the command line.
+STORES: Dict[str, Type[LayerStore]] = {
+    PillowStore.name: PillowStore,
+    TiledTiffStore.name: TiledTiffStore,
+}
+
+
+def register_store(store_class: Type[LayerStore]) -> Type[LayerStore]:
+    """Make a store selectable by its `name`. Can be used as a class decorator."""
+    STORES[store_class.name] = store_class
+    return store_class
+
+
+def get_store(store: Union[str, LayerStore, None] = None) -> LayerStore:
+    """
+    Return a layer store.
+
+    Args:
+        store (str or LayerStore): Name of a registered store, a store instance, or None for the
+            default: tiled TIFF when `tifffile` is installed, Pillow otherwise.
+
+    Returns:
+        LayerStore: The store.
+    """
+    if isinstance(store, LayerStore):
+        return store
+    if store is None:
+        try:
+            import tifffile  # noqa: F401
+            store = TiledTiffStore.name
+        except ImportError:
+            store = PillowStore.name
+    if store not in STORES:
+        raise ValueError(f"Unknown layer store '{store}'. Expected one of {sorted(STORES)}.")
+    return STORES[store]()
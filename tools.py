@@ -1,28 +1,113 @@
 import cv2
 import numpy as np
 
+from pathlib import Path
 from typing import Dict, Tuple, List
 from PIL import Image, ImageDraw, ImageFont
 
+from tracing import traced
+
+# Report templates ship with the GUI, next to this module.
+REPORT_TEMPLATE_DIR = Path(__file__).resolve().parent / 'GUI'
+
 def overlay_signal(
     image: np.ndarray,
     mask: np.ndarray,
     color: list,
     transparent: float,
 ) -> np.ndarray:
-    # Make copies of the image and mask to avoid altering original data
-    image_copy = image.copy()
-    mask_copy = mask.copy()
-
-    # Process mask for overlay visualization
-    mask_colored = cv2.cvtColor(mask_copy.astype(np.uint8), cv2.COLOR_GRAY2BGR)
+    # The inputs are only read, so read-only views can be passed without copying
+    mask_colored = cv2.cvtColor(mask.astype(np.uint8), cv2.COLOR_GRAY2BGR)
     mask_colored[np.where((mask_colored == [255, 255, 255]).all(axis=2))] = color
     
     # Create overlay image by combining raw image with masks
-    overlay_img = cv2.addWeighted(image_copy, 1, mask_colored, transparent, 0)
+    overlay_img = cv2.addWeighted(image, 1, mask_colored, transparent, 0)
     
     return overlay_img
 
+def remove_signal(
+    image: np.ndarray,
+    her2_mask: np.ndarray,
+    chr17_mask: np.ndarray,
+    method: str = 'fill',
+    distance: int = 3,
+    background_tolerance: int = 10,
+    tile_size: int = None,
+) -> np.ndarray:
+    """
+    Removes the HER2 and Chr17 signals from an image, producing the 'dug' image used for segmentation.
+
+    The signal masks are combined into one uint8 mask and dilated by `distance` pixels with a
+    fixed disk kernel, which covers the same pixels as expanding the labels by that distance.
+    The covered pixels are then filled with the background color, or inpainted.
+
+    Parameters:
+    - image (np.ndarray): RGB image the signals are removed from. It is not modified.
+    - her2_mask (np.ndarray): Mask of the HER2 signals, nonzero on signal pixels.
+    - chr17_mask (np.ndarray): Mask of the Chr17 signals, nonzero on signal pixels.
+    - method (str): 'fill' to paint the background color over the signals, 'inpaint' to fill them
+      from their surroundings with OpenCV's Telea inpainting.
+    - distance (int): Dilation of the signal masks, in pixels.
+    - background_tolerance (int): With 'fill', pixels differing from the mean image color by more
+      than this in every channel make up the background.
+    - tile_size (int): With 'fill', use the background color of each tile of this size instead of
+      the whole image, which follows uneven staining. None uses a single color.
+
+    Returns:
+    - np.ndarray: The image without signals, with the dtype of `image`.
+    """
+    if method not in ('fill', 'inpaint'):
+        raise ValueError(f"Unsupported signal removal method: {method}")
+    
+    # Combine the masks as uint8, so overlapping signals cannot overflow
+    signal = ((her2_mask != 0) | (chr17_mask != 0)).view(np.uint8)
+    yy, xx = np.mgrid[-distance:distance + 1, -distance:distance + 1]
+    kernel = (yy ** 2 + xx ** 2 <= distance ** 2).astype(np.uint8)
+    signal = cv2.dilate(signal, kernel)
+    
+    if method == 'inpaint':
+        return cv2.inpaint(np.ascontiguousarray(image), signal, distance, cv2.INPAINT_TELEA)
+    
+    # Sums are taken by OpenCV: exact on integer pixels, and much faster than float math on every pixel
+    channels = image.shape[2]
+    channel_mean = np.array(cv2.sumElems(image)[:channels]) / (image.shape[0] * image.shape[1])
+    
+    # Background pixels differ from the mean color by more than the tolerance in every channel
+    if image.dtype == np.uint8:
+        # Compare through a lookup table per channel
+        table = np.stack([np.abs(np.arange(256) - mean) > background_tolerance for mean in channel_mean], axis=-1)
+        flags = cv2.split(cv2.LUT(image, table.astype(np.uint8)[np.newaxis]))
+        background = flags[0]
+        for channel_flags in flags[1:]:
+            background = cv2.bitwise_and(background, channel_flags)
+    else:
+        background = np.all(np.abs(image - channel_mean) > background_tolerance, axis=-1).view(np.uint8)
+    
+    def background_color(region: np.ndarray, region_background: np.ndarray, default: np.ndarray) -> np.ndarray:
+        count = cv2.countNonZero(region_background)
+        if not count:
+            return default
+        return np.array(cv2.sumElems(cv2.bitwise_and(region, region, mask=region_background))[:channels]) / count
+    
+    # The dilated mask holds 0 and 1, so it can be used as a boolean mask directly
+    signal = signal.view(bool)
+    dug_image = image.copy()
+    fill = background_color(image, background, channel_mean)
+    if tile_size is None:
+        dug_image[signal] = fill
+        return dug_image
+    
+    height, width = image.shape[:2]
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            tile_signal = signal[y:y + tile_size, x:x + tile_size]
+            if not tile_signal.any():
+                continue
+            tile = image[y:y + tile_size, x:x + tile_size]
+            tile_fill = background_color(tile, background[y:y + tile_size, x:x + tile_size], fill)
+            dug_image[y:y + tile_size, x:x + tile_size][tile_signal] = tile_fill
+    return dug_image
+
 def cropping_region(
     input_cell_mask: np.ndarray,
     id_value: int,
@@ -67,6 +152,87 @@ def cropping_region(
 
     return x1, y1, x2, y2, cell_mask, contours
 
+def select_report_cells(
+    cargo,
+    needed_cell: int = 20,
+    extended_cell: int = 40,
+    borderline: Tuple[float, float] = (1.8, 2.2),
+) -> Tuple[Dict[str, Tuple[Image.Image, Image.Image]], Dict[str, Tuple[int, int]]]:
+    """
+    Picks the best-scoring cells of a case and crops them for the report.
+
+    The top `needed_cell` cells are used unless their HER2/Chr17 ratio is borderline, in
+    which case the top `extended_cell` cells are used instead.
+
+    Parameters:
+    - cargo (CaseCargo): A processed case whose `all_cell_score` is ranked by descending score.
+    - needed_cell (int): Number of cells reported normally.
+    - extended_cell (int): Number of cells reported for a borderline ratio.
+    - borderline (Tuple[float, float]): Inclusive ratio range that triggers the extended count.
+
+    Returns:
+    - image_dict (Dict[str, Tuple[Image.Image, Image.Image]]): Raw and overlay crop of every cell.
+    - cell_dict (Dict[str, Tuple[int, int]]): HER2 and Chr17 count of every cell.
+    """
+    top_cells = cargo.all_cell_score[:needed_cell]
+    total_her2 = top_cells['her2'].sum()
+    total_chr17 = top_cells['chr17'].sum()
+    
+    if total_chr17 and borderline[0] <= round(total_her2 / total_chr17, 3) <= borderline[1]:
+        needed_cell = extended_cell
+    
+    image_dict, cell_dict = {}, {}
+    layers = {}
+    for name, cell_label, _, her2, chr17, _ in cargo.all_cell_score[:needed_cell]:
+        # Build the colored masks once per image, not once per cell
+        if name not in layers:
+            container = cargo.get_container(name=name)
+            her2_mask = cv2.cvtColor(container.view('her2').astype(np.uint8), cv2.COLOR_GRAY2BGR)
+            her2_mask[np.where((her2_mask == [255, 255, 255]).all(axis=2))] = [0, 255, 0]
+            chr17_mask = cv2.cvtColor(container.view('chr17').astype(np.uint8), cv2.COLOR_GRAY2BGR)
+            chr17_mask[np.where((chr17_mask == [255, 255, 255]).all(axis=2))] = [0, 200, 255]
+            layers[name] = (container.view(label= 'raw'), her2_mask, chr17_mask, container.view(label= 'cell'))
+        raw_image, her2_mask, chr17_mask, cells_mask = layers[name]
+        
+        x1, y1, x2, y2, cell_mask, contours = cropping_region(
+            input_cell_mask= cells_mask,
+            id_value= cell_label,
+            extend= 10,
+        )
+        boundary_image = raw_image[y1:y2, x1:x2].copy()
+        boundary_image = cv2.drawContours(boundary_image, contours, 0, (255, 255, 0), 1, offset=(-x1, -y1))
+        
+        overlay_img = cv2.addWeighted(boundary_image.copy(), 1, her2_mask[y1:y2, x1:x2], 0.5, 0)
+        overlay_img = cv2.addWeighted(overlay_img, 1, chr17_mask[y1:y2, x1:x2], 0.5, 0)
+        
+        cell_name = f'{name}_Cell-{str(cell_label).zfill(3)}'
+        image_dict[cell_name] = [Image.fromarray(boundary_image).convert('RGB'), Image.fromarray(overlay_img).convert('RGB')]
+        cell_dict[cell_name] = [int(her2), int(chr17)]
+    
+    return image_dict, cell_dict
+
+def _load_font(size: int) -> ImageFont.ImageFont:
+    """
+    Loads Times New Roman at the given size, falling back to DejaVu Serif or Pillow's default font.
+
+    Parameters:
+    - size (int): Font size in points.
+
+    Returns:
+    - ImageFont.ImageFont: The first font that could be loaded.
+    """
+    for font_name in ('times.ttf', 'Times New Roman.ttf', 'DejaVuSerif.ttf'):
+        try:
+            return ImageFont.truetype(font_name, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:
+        # Pillow < 10.1 has no sized default font
+        return ImageFont.load_default()
+
+@traced('report')
 def create_report(
     image_dict: Dict[str, Tuple[Image.Image, Image.Image]],
     cell_dict: Dict[str, Tuple[int, int]],
@@ -85,11 +251,11 @@ def create_report(
     sheet = workbook.active
     sheet.append(['HER2-DISH Analysis Report'])
     
-    font = ImageFont.truetype('times.ttf', 16)
+    font = _load_font(16)
     
-    report_0 = Image.open(r'.\GUI\report-0.png')
-    report_1 = Image.open(r'.\GUI\report-1.png')
-    report_2 = Image.open(r'.\GUI\report-2.png')
+    report_0 = Image.open(REPORT_TEMPLATE_DIR / 'report-0.png')
+    report_1 = Image.open(REPORT_TEMPLATE_DIR / 'report-1.png')
+    report_2 = Image.open(REPORT_TEMPLATE_DIR / 'report-2.png')
     
     draw_0 = ImageDraw.Draw(report_0)
     draw_1 = ImageDraw.Draw(report_1)
@@ -150,7 +316,8 @@ def create_report(
     else:
         sheet.append(["Cell ID", "HER2", "Chr17", "Cell ID", "HER2", "Chr17"])
     
-    for element in sheet_row: sheet.append(element)
+    for element in sheet_row:
+        if element is not None: sheet.append(element)
     
     sheet.append(['Total:', total_her2, total_chr17])
     sheet.append(['HER2 / Chr17:', round(total_her2 / total_chr17, 3)])
@@ -158,7 +325,7 @@ def create_report(
     sheet.append(['Total HER2:', total_her2])
     sheet.append(['Total Chr17:', total_chr17])
        
-    font = ImageFont.truetype('times.ttf', 24)
+    font = _load_font(24)
     from datetime import datetime
     draw_0.text((250, 250), text= datetime.today().strftime('%Y-%m-%d %H-%M'), fill= text_color, font=font)
     if round(total_her2 / total_chr17, 3) >= 2.0: 
@@ -0,0 +1,219 @@
+import functools
+import json
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Union
+
+# Spans recorded by this process and not yet drained.
+_spans: List[dict] = []
+_lock = threading.Lock()
+_enabled = os.environ.get('HER2DISH_TRACE', '') not in ('', '0')
+
+# Memory figures of a span, in bytes.
+MEMORY_FIELDS = ('rss_start', 'rss_end', 'process_peak_rss')
+
+
+def enable(enabled: bool = True) -> None:
+    """
+    Turn span recording on or off in this process.
+
+    Worker processes follow the setting of the process that submits their tasks.
+
+    Args:
+        enabled (bool): Whether spans are recorded.
+    """
+    global _enabled
+    _enabled = enabled
+
+
+def is_enabled() -> bool:
+    """Whether spans are being recorded in this process."""
+    return _enabled
+
+
+def peak_rss() -> Union[int, None]:
+    """
+    Return the peak resident set size of this process in bytes, or None if it is unavailable.
+
+    This is the high-water mark over the whole lifetime of the process, so in a long-lived worker
+    it only grows and does not tell which stage used the memory; see `current_rss` for that.
+    Uses `resource` on POSIX systems and falls back to `psutil` (e.g. on Windows) when it is installed.
+    """
+    try:
+        import resource
+        import sys
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss)
+    except ImportError:
+        return None
+
+
+def current_rss() -> Union[int, None]:
+    """
+    Return the current resident set size of this process in bytes, or None if it is unavailable.
+
+    Reads /proc/self/statm on Linux and falls back to `psutil` elsewhere when it is installed.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import psutil
+
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+
+@contextmanager
+def span(name: str, container: str = None, stage: str = None, **args):
+    """
+    Record the duration of a block as a span.
+
+    The span stores the resident set size when the block starts and ends ('rss_start', 'rss_end'),
+    which shows what the block itself allocated, and the lifetime peak of the process
+    ('process_peak_rss').
+
+    Args:
+        name (str): Name of the span.
+        container (str): Name of the container being processed, if any.
+        stage (str): Pipeline stage the span belongs to, used as its category.
+        **args: Extra JSON-serialisable values stored with the span.
+    """
+    if not _enabled:
+        yield
+        return
+
+    rss_start = current_rss()
+    start = time.time_ns()
+    try:
+        yield
+    finally:
+        end = time.time_ns()
+        record = {
+            'name': name,
+            'stage': stage or name,
+            'container': container,
+            'pid': os.getpid(),
+            'tid': threading.get_native_id(),
+            'start_us': start // 1000,
+            'duration_us': (end - start) // 1000,
+            'rss_start': rss_start,
+            'rss_end': current_rss(),
+            'process_peak_rss': peak_rss(),
+            **args,
+        }
+        with _lock:
+            _spans.append(record)
+
+
+def traced(stage: str):
+    """
+    Decorate a function so every call is recorded as a span.
+
+    If the first argument has a `name`, as containers do, it is recorded as the container. If it is
+    a list, as for batched stages, the names of its items are recorded as 'containers'.
+
+    Args:
+        stage (str): Name of the stage.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            first = args[0] if args else None
+            if isinstance(first, (list, tuple)):
+                names = {'containers': [getattr(item, 'name', None) for item in first]}
+            else:
+                names = {'container': getattr(first, 'name', None)}
+            with span(func.__name__, stage=stage, **names):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def drain() -> List[dict]:
+    """Return the spans recorded so far and clear them from this process."""
+    with _lock:
+        spans = list(_spans)
+        _spans.clear()
+    return spans
+
+
+def collect(spans: List[dict]) -> None:
+    """Add spans recorded by another process, e.g. a worker, to this process."""
+    if not spans:
+        return
+    with _lock:
+        _spans.extend(spans)
+
+
+def chrome_trace(spans: List[dict]) -> Dict[str, list]:
+    """
+    Convert spans to the Chrome trace event format, viewable in Perfetto or chrome://tracing.
+
+    Args:
+        spans (List[dict]): Spans as returned by `drain`.
+
+    Returns:
+        Dict[str, list]: Trace with one complete ('X') event per span and one name per process.
+    """
+    events = []
+    for pid in sorted({record['pid'] for record in spans}):
+        name = 'main' if pid == os.getpid() else f'worker {pid}'
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0, 'args': {'name': name}})
+
+    for record in spans:
+        args = {
+            key: value for key, value in record.items()
+            if key not in MEMORY_FIELDS + ('name', 'stage', 'pid', 'tid', 'start_us', 'duration_us')
+        }
+        for key in MEMORY_FIELDS:
+            if record.get(key) is not None:
+                args[f'{key}_mb'] = round(record[key] / 2 ** 20, 1)
+        containers = [record['container']] if record['container'] is not None else record.get('containers')
+        title = f"{record['name']} [{', '.join(map(str, containers))}]" if containers else record['name']
+        events.append({
+            'name': title,
+            'cat': record['stage'],
+            'ph': 'X',
+            'ts': record['start_us'],
+            'dur': record['duration_us'],
+            'pid': record['pid'],
+            'tid': record['tid'],
+            'args': args,
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def export_chrome_trace(path: Union[str, Path], spans: List[dict] = None) -> Path:
+    """
+    Write spans as a Chrome trace JSON file.
+
+    Args:
+        path (str or Path): Output file, e.g. 'trace.json'.
+        spans (List[dict]): Spans to write. Defaults to every span drained from this process.
+
+    Returns:
+        Path: The written file.
+    """
+    if spans is None:
+        spans = drain()
+    path = Path(path)
+    with open(path, 'w') as f:
+        json.dump(chrome_trace(spans), f)
+    return path
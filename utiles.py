@@ -1,37 +1,406 @@
+import json
+import os
+import threading
 import numpy as np
 import pandas as pd
 
+from collections.abc import MutableMapping
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
 from pathlib import Path
-from typing import Dict, List, Union
+from typing import Callable, Dict, Iterator, List, Set, Tuple, Union
 from PIL import Image
 
+from storage import LayerStore, Window, clamp_window, get_store
+from tracing import span
+
+# Content digests of files already hashed by this process, keyed by (path, size, mtime).
+_file_digests: Dict[Tuple[str, int, int], str] = {}
+
+
+def file_digest(path: Union[str, Path]) -> str:
+    """
+    Return the SHA-256 digest of a file's content.
+
+    Digests are cached per process and recomputed only when the file's size or
+    modification time changes.
+
+    Args:
+        path (str or Path): Path of the file to hash.
+
+    Returns:
+        str: Hex digest of the file.
+    """
+    import hashlib
+    
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _file_digests:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        _file_digests[key] = digest.hexdigest()
+    return _file_digests[key]
+
+
+def stage_hash(parameters: dict, *parents: str) -> str:
+    """
+    Return a hash identifying a layer from the parameters of the stage that produced it.
+
+    The hashes of the layers the stage read are chained in, so a change anywhere upstream
+    changes the hash of every layer derived from it.
+
+    Args:
+        parameters (dict): JSON-serialisable parameters of the stage.
+        *parents (str): Hashes of the input layers.
+
+    Returns:
+        str: Hex digest of the stage.
+    """
+    import hashlib
+    
+    payload = json.dumps({'parameters': parameters, 'parents': list(parents)}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class SharedArray:
+    """
+    A picklable handle to a NumPy array stored in a shared memory block.
+
+    Only the block name, shape and dtype are sent between processes, so a worker can
+    attach to the array and read or fill it in place without any pixel data being pickled.
+    The process that created the block is responsible for unlinking it.
+    """
+
+    def __init__(self, name: str, shape: Tuple[int, ...], dtype: Union[str, np.dtype]) -> None:
+        """
+        Args:
+            name (str): Name of the shared memory block.
+            shape (Tuple[int, ...]): Shape of the array.
+            dtype (str or np.dtype): Data type of the array.
+        """
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._shm: Union[shared_memory.SharedMemory, None] = None
+
+    @classmethod
+    def empty(cls, shape: Tuple[int, ...], dtype: Union[str, np.dtype]) -> 'SharedArray':
+        """Allocate a new, uninitialised shared array."""
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        handle = cls(shm.name, shape, dtype)
+        handle._shm = shm
+        return handle
+
+    @classmethod
+    def from_array(cls, array: np.ndarray) -> 'SharedArray':
+        """Copy an array into a new shared memory block."""
+        handle = cls.empty(array.shape, array.dtype)
+        handle.open()[...] = array
+        return handle
+
+    def open(self) -> np.ndarray:
+        """Attach to the block if needed and return an array backed by it."""
+        if self._shm is None:
+            self._shm = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    def close(self) -> None:
+        """Detach from the block in this process."""
+        if self._shm is None:
+            return
+        try:
+            self._shm.close()
+        except BufferError:
+            # An array still references the mapping; it is released once that array is collected
+            return
+        self._shm = None
+
+    def unlink(self) -> None:
+        """Detach from the block and free it. Only the creating process should call this."""
+        shm = self._shm or shared_memory.SharedMemory(name=self.name)
+        self._shm = shm
+        self.close()
+        shm.unlink()
+
+    def __getstate__(self) -> dict:
+        return {'name': self.name, 'shape': self.shape, 'dtype': self.dtype.str}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state['name'], state['shape'], state['dtype'])
+
+
+class SharedContainer:
+    """
+    A lightweight stand-in for ImageContainer that is sent to worker processes.
+
+    It carries shared memory handles for the layers a stage reads and for the layers it
+    writes, instead of the arrays themselves. Layers that exist in the original container
+    but were not shared show up in `images` with a value of None, so presence checks keep
+    working in the worker.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        inputs: Dict[str, SharedArray],
+        outputs: Dict[str, SharedArray],
+        present: List[str],
+    ) -> None:
+        """
+        Args:
+            name (str): Name of the original container.
+            inputs (Dict[str, SharedArray]): Shared layers the stage reads.
+            outputs (Dict[str, SharedArray]): Preallocated shared layers the stage fills.
+            present (List[str]): Every label that exists in the original container.
+        """
+        self.name = name
+        self.inputs = inputs
+        self.outputs = outputs
+        self.present = list(present)
+        self._images: Union[Dict[str, np.ndarray], None] = None
+
+    @property
+    def images(self) -> Dict[str, Union[np.ndarray, None]]:
+        """Read-only views of the shared layers, attached on first access."""
+        if self._images is None:
+            self._images = {label: None for label in self.present}
+            for label, handle in self.inputs.items():
+                view = handle.open()
+                view.flags.writeable = False
+                self._images[label] = view
+        return self._images
+
+    def get(self, label: str) -> np.ndarray:
+        """Return a copy of the image array for the specified label."""
+        return np.copy(self.view(label))
+
+    def view(self, label: str) -> np.ndarray:
+        """Return the read-only shared view of the image array for the specified label."""
+        image = self.images.get(label)
+        if image is None:
+            raise KeyError(f"Layer '{label}' was not shared with this worker.")
+        return image
+
+    def publish(self, results: Dict[str, np.ndarray]) -> List[str]:
+        """Write stage results into their preallocated output blocks and return their labels."""
+        for label, array in results.items():
+            self.outputs[label].open()[...] = array
+        return list(results)
+
+    def read(self, label: str) -> np.ndarray:
+        """Return a private copy of an output layer written by a worker."""
+        return np.array(self.outputs[label].open())
+
+    def close(self) -> None:
+        """Drop the views and detach from every block in this process."""
+        self._images = None
+        for handle in [*self.inputs.values(), *self.outputs.values()]:
+            handle.close()
+
+    def unlink_outputs(self) -> None:
+        """Free the output blocks. Called by the process that allocated them."""
+        for handle in self.outputs.values():
+            handle.unlink()
+
+    def __getstate__(self) -> dict:
+        return {'name': self.name, 'inputs': self.inputs, 'outputs': self.outputs, 'present': self.present}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(**state)
+
+
+class LayerWriter:
+    """
+    Saves container layers on background threads, so the process scheduling the stages never
+    waits for TIFF encoding.
+
+    `submit` never blocks. Once `max_pending` writes are queued or running the writer reports
+    itself `saturated`, and the scheduler holds back new stages until it catches up, which
+    bounds the backlog when the disk cannot keep up.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 16) -> None:
+        """
+        Args:
+            max_workers (int): Number of writer threads.
+            max_pending (int): Number of writes queued or in progress at which the writer is saturated.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='layer-writer')
+        self._pending: Set[Future] = set()
+        self._lock = threading.Lock()
+        self.max_pending = max_pending
+
+    def submit(self, func, *args, after: Future = None) -> Future:
+        """
+        Queue `func(*args)` and return its future.
+
+        Args:
+            after (Future): Earlier write that must finish first, e.g. of the same layer. It was
+                queued before this one, so waiting for it on the writer thread cannot deadlock.
+        """
+        def run():
+            if after is not None:
+                wait([after])
+            return func(*args)
+
+        future = self._executor.submit(run)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+
+    @property
+    def saturated(self) -> bool:
+        """Whether `max_pending` or more writes are queued or running."""
+        with self._lock:
+            return len(self._pending) >= self.max_pending
+
+    def pending(self) -> List[Future]:
+        """Return the writes queued or running, e.g. to wait for one of them to finish."""
+        with self._lock:
+            return list(self._pending)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self) -> 'LayerWriter':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+
+
+class LazyLayers(MutableMapping):
+    """
+    Layers of a container, each decoded from disk on first access.
+
+    A deferred layer already counts as present (`in`, `len`, iteration), so existence checks
+    never decode anything. If a deferred layer fails to load, the error is printed and the
+    layer is dropped, as if it had never existed.
+    """
+
+    def __init__(self, loader: Callable[[str, Path], np.ndarray]) -> None:
+        """
+        Args:
+            loader (Callable): Called as `loader(label, path)` to decode a deferred layer.
+        """
+        self._loader = loader
+        self._layers: Dict[str, Union[np.ndarray, None]] = {}
+        self._paths: Dict[str, Path] = {}
+
+    def defer(self, label: str, path: Path) -> None:
+        """Register a layer to be read from `path` when it is first accessed."""
+        self._layers[label] = None
+        self._paths[label] = path
+
+    def is_loaded(self, label: str) -> bool:
+        """Whether the layer is decoded in memory."""
+        return self._layers.get(label) is not None
+
+    def __getitem__(self, label: str) -> np.ndarray:
+        array = self._layers[label]
+        if array is None:
+            path = self._paths.pop(label)
+            try:
+                array = self._loader(label, path)
+            except Exception as e:
+                print(f"Error loading image for {label} at {path}: {e}")
+                del self._layers[label]
+                raise KeyError(label) from e
+            self._layers[label] = array
+        return array
+
+    def __setitem__(self, label: str, array: np.ndarray) -> None:
+        self._paths.pop(label, None)
+        self._layers[label] = array
+
+    def __delitem__(self, label: str) -> None:
+        del self._layers[label]
+        self._paths.pop(label, None)
+
+    def pop(self, label: str, *default):
+        # Dropping a deferred layer must not decode it first
+        if label not in self._layers:
+            if default:
+                return default[0]
+            raise KeyError(label)
+        array = self._layers.pop(label)
+        self._paths.pop(label, None)
+        return array
+
+    def __contains__(self, label: object) -> bool:
+        return label in self._layers
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._layers))
+
+    def __len__(self) -> int:
+        return len(self._layers)
+
+
 class ImageContainer:
-    def __init__(self, image_path: str, output_path: str) -> None:
+    # Layers holding only 0 and one foreground value, which the store may pack to 1 bit.
+    binary_labels: List[str] = ['her2', 'chr17']
+
+    def __init__(
+        self,
+        image_path: str,
+        output_path: str,
+        store: Union[str, LayerStore, None] = None,
+        layer_index: Dict[str, dict] = None,
+    ) -> None:
         """
         Initialize the container with an image path and output path.
-        If any additional images (her2, chr17, dug, etc.) exist in the output path, they will be loaded.
+        If any additional images (her2, chr17, dug, etc.) exist in the output path, they are
+        registered and decoded on first access.
 
         Args:
             image_path (str): Path to the raw image.
             output_path (str): Path to the output directory where images will be saved.
+            store (str or LayerStore): On-disk format of the saved layers (see `storage.get_store`).
+                Layers in any supported format are read back, so older outputs still load.
+            layer_index (Dict[str, dict]): Shape, dtype, size and modification time of each saved
+                layer, e.g. from the case's layer index. Entries are updated in place, and stale
+                ones are refreshed from the file headers.
 
         Attributes:
-            images (Dict[str, np.ndarray]): Dictionary storing image arrays.
+            images (LazyLayers): Dictionary storing image arrays, loaded on first access.
             labels (List[str]): List of possible image labels.
             output_path (Path): Path object for the output directory.
             name (str): Base name of the image.
             extension (str): Extension of the image file.
+            shared (Dict[str, SharedArray]): Layers currently published to shared memory.
+            manifest (Dict[str, str]): Hash of the stage that produced each saved layer.
+            store (LayerStore): Writes and reads the saved layers.
+            layer_index (Dict[str, dict]): Shape and dtype of every saved layer.
+            writer (LayerWriter): If set, `add_image` saves layers in the background (see `flush`).
+            pending_writes (Dict[str, Future]): Background writes not yet flushed, by label.
         """
-        self.images: Dict[str, np.ndarray] = {}
+        self.images: LazyLayers = LazyLayers(self._read_layer)
+        self.shared: Dict[str, SharedArray] = {}
         self.cell_score: Dict[str, np.ndarray] = {}
         self.labels: List[str] = ['raw', 'her2', 'chr17', 'dug', 'cell', 'overlay']
         self.output_path: Path = Path(output_path)
         self.name: Union[str, None] = None
         self.extension: Union[str, None] = None
+        self.manifest: Dict[str, str] = {}
+        self.store: LayerStore = get_store(store)
+        self.layer_index: Dict[str, dict] = {} if layer_index is None else layer_index
+        self.writer: Union[LayerWriter, None] = None
+        self.pending_writes: Dict[str, Future] = {}
         
         # Load the raw image and check for the existence of other images
         self._load_raw_image(image_path)
         self._check_and_load_images()
+        self._load_manifest()
 
     def _load_raw_image(self, image_path: str) -> None:
         """Load the raw image from the given file path."""
@@ -42,17 +411,167 @@ class ImageContainer:
         if self.extension not in ['.tiff', '.tif', '.jpg', '.jpeg', '.png']:
             raise ValueError(f"Unsupported file extension for raw image: {self.extension}")
 
-        # Use the _input_path function to load the 'raw' image
-        self._input_path('raw', image_path)
-        # Save the 'raw' image after loading
-        self._save('raw')
+        # The 'raw' image is read from the source file on first access
+        self.images.defer('raw', self.path)
+        self._export_raw_image()
+
+    def _export_raw_image(self) -> None:
+        """
+        Place the raw image in the output folder, once.
+
+        TIFF sources are hardlinked, or copied when the output is on another file system; other
+        formats are encoded by the store. The export is reused for as long as the source keeps
+        its size and modification time, so opening a case does not decode the raw image.
+        """
+        import shutil
+
+        raw_path = self.layer_path('raw')
+        source = self.path.stat()
+        source_key = [source.st_size, source.st_mtime_ns]
+        
+        entry = self.layer_index.get('raw')
+        if entry is not None and entry.get('source') == source_key and raw_path.exists():
+            stat = raw_path.stat()
+            if entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+                return
+        # The digest of an unchanged source survives a new export (see `raw_digest`)
+        source_digest = entry.get('source_digest') if entry is not None and entry.get('source') == source_key else None
+        
+        if self.extension in ['.tiff', '.tif']:
+            # A link, or a copy made by copy2, keeps the size and modification time of the source
+            stat = raw_path.stat() if raw_path.exists() else None
+            if stat is None or [stat.st_size, stat.st_mtime_ns] != source_key:
+                raw_path.unlink(missing_ok=True)
+                try:
+                    os.link(self.path, raw_path)
+                except OSError:
+                    shutil.copy2(self.path, raw_path)
+            self.layer_index.pop('raw', None)
+            if self._index_layer('raw', raw_path) is None:
+                raise RuntimeError(f"Error exporting raw image {self.path} to {raw_path}")
+        else:
+            self._save('raw')
+        self.layer_index['raw']['source'] = source_key
+        if source_digest is not None:
+            self.layer_index['raw']['source_digest'] = source_digest
+
+    @property
+    def raw_digest(self) -> str:
+        """
+        SHA-256 digest of the raw source file.
+
+        It is kept in the layer index with the size and modification time of the source, so the
+        scan is hashed once and later runs reuse the digest for as long as the file is unchanged.
+        """
+        source = self.path.stat()
+        entry = self.layer_index.get('raw', {})
+        if entry.get('source') != [source.st_size, source.st_mtime_ns]:
+            return file_digest(self.path)
+        if 'source_digest' not in entry:
+            entry['source_digest'] = file_digest(self.path)
+        return entry['source_digest']
     
     def _check_and_load_images(self) -> None:
-        """Check if additional images (her2, chr17, dug, etc.) exist in the output path and load them."""
+        """Check if additional images (her2, chr17, dug, etc.) exist in the output path and register them."""
         for label in self.labels[1:]:  # Skip the 'raw' label
-            potential_image_path = self.output_path / f'{self.name}_{label}.tif'
-            if potential_image_path.exists():
-                self._input_path(label, potential_image_path)
+            potential_image_path = self.layer_path(label)
+            if self._index_layer(label, potential_image_path) is not None:
+                self.images.defer(label, potential_image_path)
+
+    def _index_layer(self, label: str, layer_path: Path) -> Union[dict, None]:
+        """
+        Return the layer index entry of a saved layer, reading the file header only if the
+        file changed since it was indexed. Returns None if the layer does not exist or is unreadable.
+        """
+        try:
+            stat = layer_path.stat()
+        except OSError:
+            self.layer_index.pop(label, None)
+            return None
+        
+        entry = self.layer_index.get(label)
+        if entry is not None and entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+            return entry
+        
+        try:
+            shape, dtype = self.store.probe(layer_path)
+        except Exception as e:
+            print(f"Error loading image for {label} at {layer_path}: {e}")
+            self.layer_index.pop(label, None)
+            return None
+        entry = {'shape': list(shape), 'dtype': dtype, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        self.layer_index[label] = entry
+        return entry
+
+    def layer_info(self, label: str) -> Tuple[Tuple[int, ...], np.dtype]:
+        """
+        Return the shape and dtype of a layer without decoding it.
+
+        Args:
+            label (str): Layer to describe.
+
+        Returns:
+            Tuple[Tuple[int, ...], np.dtype]: Shape and dtype of the layer.
+        """
+        if self.images.is_loaded(label) or label not in self.layer_index:
+            array = self.images[label]
+            return array.shape, array.dtype
+        entry = self.layer_index[label]
+        return tuple(entry['shape']), np.dtype(entry['dtype'])
+
+    def layer_path(self, label: str) -> Path:
+        """Return the file the specified layer is saved to."""
+        return self.output_path / f'{self.name}_{label}.tif'
+
+    @property
+    def manifest_path(self) -> Path:
+        """Path of the JSON file recording the stage hash of every saved layer."""
+        return self.output_path / f'{self.name}_manifest.json'
+
+    def _load_manifest(self) -> None:
+        """Load the stage hashes of the saved layers. Layers without one are treated as stale."""
+        if not self.manifest_path.exists():
+            return
+        try:
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        except Exception as e:
+            print(f"Error loading manifest at {self.manifest_path}: {e}")
+            self.manifest = {}
+
+    def _save_manifest(self) -> None:
+        """
+        Write the manifest atomically, so an interrupted run never leaves it half written.
+
+        Layers still being written in the background are left out until `flush`, so the file on
+        disk never vouches for a layer whose new version is not complete.
+        """
+        manifest = {label: layer_hash for label, layer_hash in self.manifest.items() if label not in self.pending_writes}
+        temp_path = self.manifest_path.with_suffix('.json.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+    def is_current(self, label: str, layer_hash: str) -> bool:
+        """Whether the layer exists and was produced by a stage with the given hash."""
+        return label in self.images and self.manifest.get(label) == layer_hash
+
+    def record(self, label: str, layer_hash: str) -> None:
+        """
+        Record the hash of the stage that produced a layer in the manifest.
+
+        While the layer is still being written in the background, the hash is only written to
+        disk by `flush` (see `_save_manifest`).
+        """
+        self.manifest[label] = layer_hash
+        if label not in self.pending_writes:
+            self._save_manifest()
+
+    def invalidate(self, label: str) -> None:
+        """Drop a stale layer and its manifest entry so the stage producing it runs again."""
+        self.delete(label)
+        if self.manifest.pop(label, None) is not None:
+            self._save_manifest()
 
     def add_image(self, label: str, data: Union[str, np.ndarray]) -> None:
         """
@@ -65,6 +584,11 @@ class ImageContainer:
         if label not in self.labels:
             raise ValueError(f"Invalid label: {label}. Expected one of {self.labels}.")
 
+        # Any shared copy of the previous layer is now stale, and so is its recorded stage hash
+        self._release_shared(label)
+        if self.manifest.pop(label, None) is not None:
+            self._save_manifest()
+
         if isinstance(data, str):
             self._input_path(label, data)  # Load from path
         elif isinstance(data, np.ndarray):
@@ -73,7 +597,33 @@ class ImageContainer:
             raise ValueError(f"Unsupported input type for {label}. Expected a file path (str) or a NumPy array.")
 
         # Automatically save after adding the image
-        self._save(label)
+        if self.writer is None:
+            self._save(label)
+        else:
+            # A newer version of the layer must not be overtaken by an older write
+            previous = self.pending_writes.get(label)
+            self.pending_writes[label] = self.writer.submit(self._write, label, self.images[label], after=previous)
+
+    def flush(self) -> None:
+        """
+        Wait for the background writes of this container and persist the manifest.
+
+        Raises:
+            RuntimeError: The first write that failed. Its layer is dropped from the manifest,
+                so it is recomputed by the next run.
+        """
+        if not self.pending_writes:
+            return
+        pending, self.pending_writes = self.pending_writes, {}
+        errors = []
+        for label, future in pending.items():
+            error = future.exception()
+            if error is not None:
+                self.manifest.pop(label, None)
+                errors.append(error)
+        self._save_manifest()
+        if errors:
+            raise errors[0]
         
     def _input_path(self, label: str, input_path: Path) -> None:
         """Load an image from the given file path and add it to the container."""
@@ -85,12 +635,23 @@ class ImageContainer:
         except Exception as e:
             print(f"Error loading image for {label} at {input_path}: {e}")
 
+    def _read_layer(self, label: str, layer_path: Path) -> np.ndarray:
+        """Decode a deferred layer: the raw input with Pillow, saved layers with the store."""
+        if label == 'raw' and layer_path == self.path:
+            with Image.open(layer_path) as img:
+                return np.array(img)
+        return self.store.load(layer_path)
+
     def _input_array(self, label: str, input_array: np.ndarray) -> None:
         """Add an image directly from a NumPy array."""
-        if label in ['her2', 'chr17', 'cell']:
+        if label in ['her2', 'chr17']:
             # Ensure these are grayscale 16-bit images
             if input_array.ndim != 2 or input_array.dtype != np.uint16:
                 raise ValueError(f"{label} must be a grayscale 16-bit image.")
+        elif label == 'cell':
+            # Cell labels are 16-bit, or 32-bit for scans with more than 65535 cells
+            if input_array.ndim != 2 or input_array.dtype not in (np.uint16, np.uint32):
+                raise ValueError(f"{label} must be a grayscale 16-bit or 32-bit label image.")
         elif label in ['dug', 'overlay']:
             # Ensure dug is RGB
             if input_array.ndim != 3 or input_array.shape[2] != 3:
@@ -100,25 +661,117 @@ class ImageContainer:
         
     def _save(self, label: str) -> None:
         """Save the specified image using the stored output path with the format."""
+        self._write(label, self.images[label])
+
+    def _write(self, label: str, img: np.ndarray) -> None:
+        """
+        Write a layer to its file and update its layer index entry. Safe to run on a writer thread.
+
+        The layer is written to a temporary file that then replaces the old one, so readers never
+        see a partial file, and a hardlinked raw export is never written through to its source.
+        """
+        output_file_path = self.layer_path(label)
+        temp_file_path = output_file_path.with_name(f'.{output_file_path.stem}.{threading.get_ident()}.tmp.tif')
         try:
-            img = self.images[label]
-            output_file_path = self.output_path / f'{self.name}_{label}.tif'
-            img_pil = Image.fromarray(img)
-            img_pil.save(output_file_path)
+            with span('save', container=self.name, stage='save', label=label):
+                self.store.save(temp_file_path, img, binary=label in self.binary_labels)
+                os.replace(temp_file_path, output_file_path)
+            stat = output_file_path.stat()
+            self.layer_index[label] = {
+                'shape': list(img.shape), 'dtype': img.dtype.name,
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            }
         except Exception as e:
+            temp_file_path.unlink(missing_ok=True)
             raise RuntimeError(f"Error saving image {label} to {output_file_path}: {e}")
         
     def get(self, label: str) -> np.ndarray:
-        """Return a copy of the image array for the specified label."""
+        """Return a copy of the image array for the specified label, for callers that modify it."""
         return np.copy(self.images[label])
+
+    def view(self, label: str) -> np.ndarray:
+        """
+        Return a read-only view of the image array for the specified label, without copying it.
+        Writing to the view raises; use `get` for a copy that can be modified.
+        """
+        view = self.images[label].view()
+        view.flags.writeable = False
+        return view
     
+    def read_window(self, label: str, window: Window) -> np.ndarray:
+        """
+        Return part of a layer, reading only that part from disk if the layer is not loaded.
+
+        Args:
+            label (str): Layer to read.
+            window (Window): Rows y0:y1 and columns x0:x1, as (y0, y1, x0, x1).
+
+        Returns:
+            np.ndarray: A copy of the window, clipped to the layer (see `storage.clamp_window`).
+        """
+        if self.images.is_loaded(label):
+            image = self.images[label]
+            y0, y1, x0, x1 = clamp_window(window, *image.shape[:2])
+            return np.copy(image[y0:y1, x0:x1])
+        return self.store.read_window(self.layer_path(label), window)
+
     def delete(self, label: str):
         """Delete the image array for the specified label."""
+        self._release_shared(label)
         if label in self.images:
             self.images.pop(label)
+    
+    def share(
+        self,
+        labels: List[str],
+        outputs: Dict[str, Tuple[Tuple[int, ...], np.dtype]] = None,
+    ) -> SharedContainer:
+        """
+        Publish layers to shared memory and return a handle that can be sent to a worker.
+
+        Each layer is copied into shared memory once and reused by later calls until it
+        changes or `release_shared` is called.
+
+        Args:
+            labels (List[str]): Labels of the layers the worker reads. Missing labels are skipped.
+            outputs (Dict[str, Tuple]): Shape and dtype of every layer the worker will write.
+
+        Returns:
+            SharedContainer: Picklable handle to the shared layers.
+        """
+        inputs = {}
+        for label in labels:
+            if label not in self.images:
+                continue
+            if label not in self.shared:
+                self.shared[label] = SharedArray.from_array(self.images[label])
+            inputs[label] = self.shared[label]
+        
+        output_blocks = {
+            label: SharedArray.empty(shape, dtype)
+            for label, (shape, dtype) in (outputs or {}).items()
+        }
+        return SharedContainer(self.name, inputs, output_blocks, list(self.images))
+    
+    def release_shared(self) -> None:
+        """Free every shared memory block published by this container."""
+        for label in list(self.shared):
+            self._release_shared(label)
+    
+    def _release_shared(self, label: str) -> None:
+        """Free the shared memory block of a single layer if it was published."""
+        handle = self.shared.pop(label, None)
+        if handle is not None:
+            handle.unlink()
         
 class CaseCargo:
-    def __init__(self, input_path: str, output_path: str) -> None:
+    def __init__(
+        self,
+        input_path: str,
+        output_path: str,
+        store: Union[str, LayerStore, None] = None,
+        io_workers: int = 8,
+    ) -> None:
         """
         Initialize the CaseCargo class with input and output paths.
         The input_path contains raw images, and each raw image will create a new ImageContainer.
@@ -128,16 +781,25 @@ class CaseCargo:
         Args:
             input_path (str): The path where the raw images are located.
             output_path (str): The base output directory where all the container folders will be saved.
+            store (str or LayerStore): On-disk format of the container layers (see `storage.get_store`).
+            io_workers (int): Number of containers opened concurrently, which hides the file system
+                latency of e.g. network shares. 1 opens them one by one.
         """
         self.input_path: Path = Path(input_path)
         self.output_path: Path = Path(output_path) / f'{self.input_path.stem}_output'
         self.report_path: Path = self.output_path / f'Final-Report_{self.input_path.stem}.png'
         self.all_cell_excel_path: Path = self.output_path / f'{self.input_path.stem}_all-cell-score.xlsx'
         self.report_excel_path: Path = self.output_path / f'Final-Report_{self.input_path.stem}.xlsx'
+        self.layer_index_path: Path = self.output_path / 'layers.json'
         self.all_cell_score: List = []
+        # Number of cells scored, before `all_cell_score` is cut to the best ones
+        self.scored_cells: int = 0
         self.temp_cell_score: List = []
         self.final_cell_score: Dict = {}
         self.final_cell_image: Dict = {}
+        self.store: LayerStore = get_store(store)
+        self.layer_index: Dict[str, Dict[str, dict]] = {}
+        self.io_workers: int = max(1, io_workers)
         # Ensure the input path exists
         if not self.input_path.exists():
             raise ValueError(f"Input path {self.input_path} does not exist.")
@@ -149,7 +811,9 @@ class CaseCargo:
         self.containers: Dict[str, ImageContainer] = {}
         
         # Create containers for each raw image
+        self._load_layer_index()
         self.create_containers()
+        self.save_layer_index()
         self._load_existing_excel()
 
     def list_images(self) -> List[Path]:
@@ -162,8 +826,8 @@ class CaseCargo:
         # Supported raw image extensions
         supported_extensions = ['.tiff', '.tif', '.jpg', '.jpeg', '.png']
 
-        # Get list of raw image paths
-        image_paths = [f for f in self.input_path.iterdir() if f.suffix.lower() in supported_extensions]
+        # Get list of raw image paths, sorted so the container order does not depend on the file system
+        image_paths = sorted(f for f in self.input_path.iterdir() if f.suffix.lower() in supported_extensions)
         return image_paths
 
     def create_containers(self) -> None:
@@ -172,23 +836,79 @@ class CaseCargo:
         Each container will be initialized with the raw image and output path,
         and will automatically check for the existence of additional images (her2, chr17, etc.).
         The output folders for all containers will be stored in the base output folder.
-        Containers are stored in a dictionary for easy access.
+        Containers are stored in a dictionary for easy access, in the order of `list_images`.
+
+        Up to `io_workers` containers are opened concurrently on threads, which also hash the
+        raw images that are new or changed since the layer index was saved.
         """
         image_paths = self.list_images()
-
-        for image_path in image_paths:
-            # Derive the container name from the raw image file name (without extension)
-            container_name = image_path.stem
-
+        
+        # Each container updates only its own entry, so the threads never share one
+        layer_indexes = [self.layer_index.setdefault(image_path.stem, {}) for image_path in image_paths]
+        
+        def open_container(image_path: Path, layer_index: Dict[str, dict]) -> ImageContainer:
             # Create a unique output directory for this container inside the base output folder
-            container_output_path = self.output_path / container_name
+            container_output_path = self.output_path / image_path.stem
             container_output_path.mkdir(parents=True, exist_ok=True)
 
             # Create a new ImageContainer for this raw image
-            image_container = ImageContainer(str(image_path), str(container_output_path))
+            container = ImageContainer(
+                str(image_path), str(container_output_path),
+                store=self.store, layer_index=layer_index,
+            )
+            # Hash a new or changed scan here, off the thread that schedules the stages
+            container.raw_digest
+            return container
+
+        if self.io_workers == 1 or len(image_paths) < 2:
+            image_containers = list(map(open_container, image_paths, layer_indexes))
+        else:
+            with ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='case-open') as executor:
+                image_containers = list(executor.map(open_container, image_paths, layer_indexes))
+
+        for image_path, image_container in zip(image_paths, image_containers):
+            # Store the container in the dictionary with the container name (the raw image file name) as the key
+            self.containers[image_path.stem] = image_container
+
+    def _load_layer_index(self) -> None:
+        """Load the shape and dtype of every saved layer, so opening the case decodes nothing."""
+        if not self.layer_index_path.exists():
+            return
+        try:
+            with open(self.layer_index_path, 'r') as f:
+                self.layer_index = json.load(f)
+        except Exception as e:
+            print(f"Error loading layer index at {self.layer_index_path}: {e}")
+            self.layer_index = {}
 
-            # Store the container in the dictionary with the container_name as the key
-            self.containers[container_name] = image_container
+    def save_layer_index(self) -> None:
+        """Write the layer index atomically, keeping only the containers of this case."""
+        index = {name: self.layer_index.get(name, {}) for name in self.containers}
+        temp_path = self.layer_index_path.with_suffix('.json.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.layer_index_path)
+
+    def set_writer(self, writer: Union[LayerWriter, None]) -> None:
+        """Save the layers added to every container with `writer` in the background, or synchronously if None."""
+        for container in self.containers.values():
+            container.writer = writer
+
+    def flush(self) -> None:
+        """
+        Wait for the background writes of every container.
+
+        Raises:
+            RuntimeError: The first write that failed, after every container has been flushed.
+        """
+        errors = []
+        for container in self.containers.values():
+            try:
+                container.flush()
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
 
     def get_container(self, name: str) -> ImageContainer:
         """